@@ -0,0 +1,222 @@
+"""Throughput benchmark of the single augmentations and the production
+pipeline of image_augmentation.py on a sample of rendered images.
+
+For every transform the images/second, the p50/p99 latency per image and
+the memory allocated during one call are reported. Decoding and encoding
+of the PNGs are measured separately. The results can be written as JSON
+and compared with the results of an earlier run:
+
+python augmentation_benchmark.py -i <render dir> -o result.json
+python augmentation_benchmark.py -i <render dir> --compare result.json
+"""
+import sys
+import getopt
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import albumentations
+
+from image_augmentation import (
+    HorizontalFlip, IAAPerspective, ShiftScaleRotate, CLAHE, RandomRotate90,
+    Transpose, Blur, OpticalDistortion, GridDistortion,
+    HueSaturationValue, IAAAdditiveGaussianNoise, GaussNoise,
+    MotionBlur, MedianBlur, RandomBrightnessContrast, IAAPiecewiseAffine,
+    IAASharpen, IAAEmboss, Flip, build_pipeline, decode_rgb_image, encode_png
+)
+
+IMAGE_SIZE = 500
+NUM_SAMPLES = 50
+NUM_REPEATS = 3
+NUM_ALLOC_SAMPLES = 5
+
+TRANSFORMS = [
+    (HorizontalFlip, {}), (IAAPerspective, {}), (ShiftScaleRotate, {}),
+    (CLAHE, {}), (RandomRotate90, {}), (Transpose, {}),
+    (Blur, {"blur_limit": (5, 5)}), (OpticalDistortion, {}),
+    (GridDistortion, {}), (HueSaturationValue, {}),
+    (IAAAdditiveGaussianNoise, {}), (GaussNoise, {}), (MotionBlur, {}),
+    (MedianBlur, {}), (RandomBrightnessContrast, {}),
+    (IAAPiecewiseAffine, {}), (IAASharpen, {}), (IAAEmboss, {}), (Flip, {}),
+]
+
+
+def sample_renders(path, num_samples, seed=0):
+    """encoded bytes of a random sample of the png files below path"""
+    files = []
+    for root, _, filenames in os.walk(path):
+        files += [os.path.join(root, f) for f in filenames
+                  if f.endswith('.png')]
+    files.sort()
+    files = random.Random(seed).sample(files, min(num_samples, len(files)))
+
+    samples = []
+    for file in files:
+        with open(file, 'rb') as f:
+            samples.append(f.read())
+    return samples
+
+
+def prepare_image(data):
+    image = decode_rgb_image(data)
+    if image.shape[:2] != (IMAGE_SIZE, IMAGE_SIZE):
+        image = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+
+def measure_latency(func, inputs, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for item in inputs:
+            start = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def measure_allocations(func, inputs):
+    """peak memory allocated during one call and number of memory blocks
+    the call leaves allocated (including its result), averaged over the
+    inputs. Runs separately from the timing because tracing is slow"""
+    peaks = []
+    blocks = []
+    for item in inputs:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = func(item)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = after.filter_traces(ignore).compare_to(
+            before.filter_traces(ignore), 'filename')
+        blocks.append(sum(max(stat.count_diff, 0) for stat in stats))
+        peaks.append(peak - base)
+        del result
+    return float(np.mean(peaks)), float(np.mean(blocks))
+
+
+def summarize(latencies, alloc_peak, alloc_blocks):
+    return {
+        "images_per_second": len(latencies) / latencies.sum(),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "alloc_peak_kib": alloc_peak / 1024,
+        "alloc_blocks": alloc_blocks,
+    }
+
+
+def benchmark(samples, repeats=NUM_REPEATS):
+    images = [prepare_image(data) for data in samples]
+    alloc_images = images[:NUM_ALLOC_SAMPLES]
+    results = {}
+
+    def run(name, func, inputs, alloc_inputs):
+        latencies = measure_latency(func, inputs, repeats)
+        peak, blocks = measure_allocations(func, alloc_inputs)
+        results[name] = summarize(latencies, peak, blocks)
+        print_result(name, results[name])
+
+    run("decode", decode_rgb_image, samples, samples[:NUM_ALLOC_SAMPLES])
+    run("encode", encode_png, images, alloc_images)
+
+    for transform_cls, args in TRANSFORMS:
+        aug = transform_cls(p=1, **args)
+        run(transform_cls.__name__, lambda image: aug(image=image)["image"],
+            images, alloc_images)
+
+    aug = build_pipeline()
+    run("pipeline", lambda image: aug(image=image)["image"],
+        images, alloc_images)
+
+    return results
+
+
+def print_result(name, result, reference=None):
+    line = "%-26s %9.1f img/s  p50 %8.2f ms  p99 %8.2f ms  " \
+           "peak %9.1f KiB  blocks %8.1f" % (
+               name, result["images_per_second"], result["p50_ms"],
+               result["p99_ms"], result["alloc_peak_kib"],
+               result["alloc_blocks"])
+    if reference is not None:
+        line += "  speedup %5.2fx" % (result["images_per_second"] /
+                                      reference["images_per_second"])
+    print(line)
+
+
+def compare(results, reference):
+    print("\nCompared with the reference run:")
+    for name, result in results.items():
+        if name in reference:
+            print_result(name, result, reference[name])
+
+
+def main(argv):
+    usage = ('augmentation_benchmark.py -i <render dir> [-n <samples>] '
+             '[-r <repeats>] [-o <result json>] [--compare <result json>]')
+    try:
+        opts, args = getopt.getopt(argv, "hi:n:r:o:", ["compare="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    inputpath = None
+    num_samples = NUM_SAMPLES
+    repeats = NUM_REPEATS
+    outputpath = None
+    reference_path = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt == "-i":
+            inputpath = arg
+        elif opt == "-n":
+            num_samples = int(arg)
+        elif opt == "-r":
+            repeats = int(arg)
+        elif opt == "-o":
+            outputpath = arg
+        elif opt == "--compare":
+            reference_path = arg
+    if inputpath is None:
+        print(usage)
+        sys.exit(2)
+
+    samples = sample_renders(inputpath, num_samples)
+    if not samples:
+        print("No png files found in %s" % inputpath)
+        sys.exit(1)
+    print("Benchmarking %d images, %d repeats" % (len(samples), repeats))
+
+    results = benchmark(samples, repeats)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "albumentations": albumentations.__version__,
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "num_images": len(samples),
+        "repeats": repeats,
+        "image_size": IMAGE_SIZE,
+        "results": results,
+    }
+    if outputpath is not None:
+        with open(outputpath, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if reference_path is not None:
+        with open(reference_path) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
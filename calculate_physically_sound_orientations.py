@@ -1,9 +1,14 @@
+import json
 import math
 import os
 
-from scipy.spatial import ConvexHull
 import numpy as np
-import trimesh
+
+# scipy and trimesh are imported where they are used, worker processes
+# that only need the helpers of this module start faster without them
+from compact_mesh import (FacetGroups, SEARCH_DTYPE, find_meshes,
+                          load_mesh_to_origin)
+import orientation_kernels
 
 MAX_COUNTER = 80
 CoG_THRESHOLD = 4
@@ -80,14 +85,19 @@ def calc_norm_and_area_lists(pts, hull, central_point):
     Sum up faces with the same orientation
     because they belong to the same plane
     return the list of normals and list of areas"""
+    if orientation_kernels.ENABLED:
+        return orientation_kernels.norm_and_area_lists(
+            pts, hull.simplices, central_point, AREA_COMBINE_THRESHOLD)
+
     list_of_areas = []
     list_of_all_normals = []
-    list_of_corresp_simplices = []
+    # plane of every simplex, the simplices are grouped by plane at the end
+    labels = np.empty(len(hull.simplices), dtype=np.int32)
 
     total_surface_area = 0
 
     # Loop through all simplices of the convex hull
-    for s in hull.simplices:
+    for i, s in enumerate(hull.simplices):
         p1 = [pts[s, 0][0], pts[s, 1][0], pts[s, 2][0]]
         p2 = [pts[s, 0][1], pts[s, 1][1], pts[s, 2][1]]
         p3 = [pts[s, 0][2], pts[s, 1][2], pts[s, 2][2]]
@@ -105,7 +115,7 @@ def calc_norm_and_area_lists(pts, hull, central_point):
         if (len(list_of_all_normals) == 0):
             list_of_all_normals.append(facette_normal)
             list_of_areas.append(facette_area)
-            list_of_corresp_simplices.append([list(np.array(s))])
+            labels[i] = 0
         else:
             # loop through list of normals
             for j in range(len(list_of_all_normals)):
@@ -115,20 +125,20 @@ def calc_norm_and_area_lists(pts, hull, central_point):
                 plane as a previous one and the areas will be combined"""
                 if angle < AREA_COMBINE_THRESHOLD:
                     list_of_areas[j] += facette_area
-                    list_of_corresp_simplices[j].append(list(np.array(s)))
+                    labels[i] = j
                     break
                 elif(j == (len(list_of_all_normals) - 1)):
                     """In this case there has not been a
                     facette of the same plane in the list yet"""
                     list_of_all_normals.append(facette_normal)
                     list_of_areas.append(facette_area)
-                    list_of_corresp_simplices.append([list(np.array(s))])
+                    labels[i] = len(list_of_all_normals) - 1
                     break
 
-    return list_of_all_normals,
-    list_of_areas,
-    list_of_corresp_simplices,
-    total_surface_area
+    list_of_corresp_simplices = FacetGroups.from_labels(
+        labels, hull.simplices, len(list_of_all_normals))
+    return (list_of_all_normals, list_of_areas, list_of_corresp_simplices,
+            total_surface_area)
 
 
 def sort_planes_via_area(list_of_areas, list_of_all_normals,
@@ -166,20 +176,20 @@ def sort_planes_via_area(list_of_areas, list_of_all_normals,
     return biggest_areas, normal_list, simplices_list
 
 
-def load_mesh_and_move_to_origin(object_path):
-    """load mesh and directly shift it to the origin"""
-    mesh = trimesh.load(object_path)
-
-    to_origin, extents = trimesh.bounds.oriented_bounds(mesh, 1, True, None)
-    mesh.apply_transform(to_origin)
+def load_mesh_and_move_to_origin(object_path, return_transform=False):
+    """load mesh and directly shift it to the origin, with float64
+    vertices for the search"""
+    mesh, to_origin = load_mesh_to_origin(object_path, SEARCH_DTYPE)
 
+    if return_transform:
+        return mesh, to_origin
     return mesh
 
 
-def load_mesh_rotate_with_normal_and_shift_bb(object_path, normal):
-    """load mesh, rotate it and shift it to the origin"""
-    mesh = load_mesh_and_move_to_origin(object_path)
-
+def rotate_with_normal_and_shift_bb(mesh, normal):
+    """Rotate the mesh so that the normal points down and shift it onto
+    the x-y plane. Returns the new mesh and the applied transformation"""
+    import trimesh
     # calculate the rotation vector and rotation angle around this vector
     rot_vec = trimesh.transformations.vector_product([normal[0], normal[1],
                                                       normal[2]],
@@ -191,23 +201,45 @@ def load_mesh_rotate_with_normal_and_shift_bb(object_path, normal):
 
     if rot_vec[0] == 0 and rot_vec[1] == 0 and rot_vec[2] == 0:
         rot_vec[0] = 1
-        mesh.apply_transform(trimesh.transformations.rotation_matrix(rot_angle,
-                                                                     rot_vec))
+        rotation = trimesh.transformations.rotation_matrix(rot_angle, rot_vec)
     else:
-        mesh.apply_transform(trimesh.transformations.rotation_matrix(rot_angle,
-                                                                     rot_vec))
+        rotation = trimesh.transformations.rotation_matrix(rot_angle, rot_vec)
+    mesh = mesh.transformed(rotation)
 
-    bounds = trimesh.bounds.corners(mesh.bounding_box.bounds)
-    min_z = min(bounds[:, 2])
+    min_z = mesh.bounds[0, 2]
 
     trans_mat = np.identity(4)
     trans_mat[2, 3] -= min_z
 
-    mesh.apply_transform(trans_mat)
+    return mesh.transformed(trans_mat), np.dot(trans_mat, rotation)
+
 
+def load_mesh_rotate_with_normal_and_shift_bb(object_path, normal,
+                                              return_transform=False):
+    """load mesh, rotate it and shift it to the origin.
+    With return_transform, the transformation from the coordinates of the
+    file to the returned mesh is returned as well"""
+    mesh, to_origin = load_mesh_and_move_to_origin(object_path, True)
+    mesh, transform = rotate_with_normal_and_shift_bb(mesh, normal)
+
+    if return_transform:
+        return mesh, np.dot(transform, to_origin)
     return mesh
 
 
+def write_pose_sidecar(object_path, folder_path, poses):
+    """Store the base mesh as OBJ next to the orientation folder, together
+    with the transformation of every exported orientation relative to it.
+    The renderer can then import the mesh once and apply the poses."""
+    import trimesh
+    base_path = folder_path + '_base.obj'
+    trimesh.load(object_path).export(base_path)
+    with open(folder_path + '_poses.json', 'w') as f:
+        json.dump({'base': os.path.basename(base_path),
+                   'poses': {name: np.asarray(pose).tolist()
+                             for name, pose in poses.items()}}, f)
+
+
 def update_lowest_CoG(lowest_CoG, current_CoG):
     """update the CoG list"""
     if lowest_CoG == 0:
@@ -230,7 +262,9 @@ def make_directory(path):
 
 def stability_check(mesh, center, simplices_list, total_surface):
     """Function for checking stability of an orientation"""
-    pts = mesh.vertices
+    pts = mesh.vertices.astype(np.float64)
+    if orientation_kernels.ENABLED:
+        return orientation_kernels.is_stable(pts, simplices_list, center)
 
     stable_position_found = False
     for s in simplices_list:
@@ -263,7 +297,7 @@ def stability_check(mesh, center, simplices_list, total_surface):
     return stable_position_found
 
 
-def reduce_list_with_stability_criterion(object_path, list_of_normals,
+def reduce_list_with_stability_criterion(mesh, list_of_normals,
                                          list_of_CoGs, list_of_facettes,
                                          total_surface):
     """Check all orietations regarding their stability and
@@ -273,11 +307,10 @@ def reduce_list_with_stability_criterion(object_path, list_of_normals,
     """Check if x-y-position of the CoGs lies inside the polygone.
     If true, the object is in a stable position"""
     for i in range(len(list_of_normals)):
-        mesh = load_mesh_rotate_with_normal_and_shift_bb(object_path,
-                                                         list_of_normals[i])
+        rotated, _ = rotate_with_normal_and_shift_bb(mesh, list_of_normals[i])
 
         # Stability check
-        is_stable = stability_check(mesh, list_of_CoGs[i],
+        is_stable = stability_check(rotated, list_of_CoGs[i],
                                     list_of_facettes[i], total_surface)
 
         if is_stable is True:
@@ -289,7 +322,7 @@ def reduce_list_with_stability_criterion(object_path, list_of_normals,
     return indicee_list
 
 
-def remove_redundancy(object_path, biggest_areas, normal_list, facette_list):
+def remove_redundancy(mesh, biggest_areas, normal_list, facette_list):
     """list of sizes of curved parts for checking
     if they have already been added"""
     size_save_round_part = []
@@ -324,27 +357,25 @@ def remove_redundancy(object_path, biggest_areas, normal_list, facette_list):
             reduced_normal_list.append(normal_list[i])
             reduced_facette_list.append(facette_list[i])
 
-            mesh = load_mesh_rotate_with_normal_and_shift_bb(object_path,
-                                                             normal_list[i])
+            rotated, _ = rotate_with_normal_and_shift_bb(mesh, normal_list[i])
 
-            current_CoG = mesh.center_mass
+            current_CoG = rotated.center_mass
             CoG_list.append(current_CoG)
             lowest_CoG = update_lowest_CoG(lowest_CoG, current_CoG)
 
-    return reduced_biggest_area_list,
-    reduced_normal_list,
-    reduced_facette_list,
-    CoG_list,
-    lowest_CoG
+    return (reduced_biggest_area_list, reduced_normal_list,
+            reduced_facette_list, CoG_list, lowest_CoG)
 
 
 def create_training_orientations(object_path):
     """Main function for creation of physically sound
-    training data for a 3D object"""
-    mesh = load_mesh_and_move_to_origin(object_path)
+    training data for a 3D object. The mesh is loaded once, all
+    orientations are computed from it"""
+    from scipy.spatial import ConvexHull
+    mesh, to_origin = load_mesh_and_move_to_origin(object_path, True)
 
     # load points of mesh
-    pts = mesh.vertices
+    pts = mesh.vertices.astype(np.float64)
     hull = ConvexHull(pts)
 
     # Calculation of the center of the convex hull and the bounding box
@@ -368,13 +399,13 @@ def create_training_orientations(object_path):
 
     print(len(biggest_areas), " different planes exist")
 
-    reduced_biggest_area_list, reduced_normal_list, reduced_facette_list, CoG_list, lowest_CoG = remove_redundancy(object_path, biggest_areas, normal_list, facette_list)
+    reduced_biggest_area_list, reduced_normal_list, reduced_facette_list, CoG_list, lowest_CoG = remove_redundancy(mesh, biggest_areas, normal_list, facette_list)
 
     print(len(reduced_biggest_area_list), " different planes exist after reduction")
 
     """Check if x-y-position of the CoGs lies inside the polygone.
     If true, the object is in a stable position"""
-    list_of_stable_indicees = reduce_list_with_stability_criterion(object_path, reduced_normal_list, CoG_list, reduced_facette_list, total_surf)
+    list_of_stable_indicees = reduce_list_with_stability_criterion(mesh, reduced_normal_list, CoG_list, reduced_facette_list, total_surf)
 
     print("Stable indicees are: ", list_of_stable_indicees)
 
@@ -388,6 +419,7 @@ def create_training_orientations(object_path):
             list_of_stable_and_low_indicees.append(i)
 
     naming_counter = 0
+    poses = {}
     for i in range(len(list_of_stable_and_low_indicees)):
         indicee = list_of_stable_and_low_indicees[i]
         # checking for nearly same orientations
@@ -401,25 +433,33 @@ def create_training_orientations(object_path):
                 break
 
         if (already_exists is False):
-            mesh = load_mesh_rotate_with_normal_and_shift_bb(object_path,
-                                                             reduced_normal_list[indicee])
-            folder_path = object_path[:-4]
+            rotated, transform = rotate_with_normal_and_shift_bb(
+                mesh, reduced_normal_list[indicee])
+            folder_path = os.path.splitext(object_path)[0]
             if (naming_counter == 0):
                 make_directory(folder_path)
             export_path = (folder_path + '/orientation_' +
                            str(naming_counter) + ".obj")
-            mesh.export(export_path)
+            rotated.export(export_path)
+            poses['orientation_' + str(naming_counter)] = np.dot(transform,
+                                                                 to_origin)
             naming_counter += 1
 
+    if naming_counter > 0:
+        write_pose_sidecar(object_path, os.path.splitext(object_path)[0],
+                           poses)
+
 
-path = "path/to/models/"
+def mesh_files(path):
+    """meshes of a folder in any format trimesh reads, see find_meshes"""
+    return [path + filename for filename in find_meshes(path).values()]
 
 
-filelist = []
-for filename in os.listdir(path):
-    filelist.append(path + filename)
+if __name__ == "__main__":
+    path = "path/to/models/"
 
+    filelist = mesh_files(path)
 
-for file_path in filelist:
-    print('Currently the object ', file_path, ' is processed.')
-    create_training_orientations(file_path)
+    for file_path in filelist:
+        print('Currently the object ', file_path, ' is processed.')
+        create_training_orientations(file_path)
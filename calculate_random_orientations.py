@@ -1,9 +1,12 @@
+import json
 import math
 import os
 import random
 from datetime import datetime
 
-import trimesh
+import numpy as np
+
+from compact_mesh import find_meshes, load_mesh_to_origin
 
 MAX_COUNTER = 100
 
@@ -17,29 +20,44 @@ def make_directory(path):
         print("Successfully created the directory %s " % path)
 
 
-def load_mesh_and_move_to_origin(object_path):
+def load_mesh_and_move_to_origin(object_path, return_transform=False):
     print("obj path is: ", object_path)
-    mesh = trimesh.load(object_path)
     # Move the object to the origin
+    mesh, to_origin = load_mesh_to_origin(object_path)
 
-    to_origin, extents = trimesh.bounds.oriented_bounds(mesh, 1, True, None)
-    mesh.apply_transform(to_origin)
-
+    if return_transform:
+        return mesh, to_origin
     return mesh
 
 
+def write_pose_sidecar(object_path, folder_path, poses):
+    """Store the base mesh as OBJ next to the orientation folder, together
+    with the transformation of every exported orientation relative to it.
+    The renderer can then import the mesh once and apply the poses."""
+    import trimesh
+    base_path = folder_path + '_base.obj'
+    trimesh.load(object_path).export(base_path)
+    with open(folder_path + '_poses.json', 'w') as f:
+        json.dump({'base': os.path.basename(base_path),
+                   'poses': {name: np.asarray(pose).tolist()
+                             for name, pose in poses.items()}}, f)
+
+
 def create_training_orientations(object_path):
-    mesh = load_mesh_and_move_to_origin(object_path)
-    folder_path = object_path[:-4]
+    import trimesh
+    mesh, to_origin = load_mesh_and_move_to_origin(object_path, True)
+    folder_path = os.path.splitext(object_path)[0]
     make_directory(folder_path)
+    poses = {}
+    # the rotations accumulate, they are applied to the loaded mesh at once
+    rotations = np.identity(4)
 
-    random.seed(datetime.now())
+    random.seed(datetime.now().timestamp())
 
     amount_of_orientations = MAX_COUNTER
 
     for i in range(amount_of_orientations):
         theta = 2 * math.pi * random.random()
-        random.seed(datetime.now())
         phi = math.acos(1 - 2 * random.random())
         normal_x = math.sin(phi) * math.cos(theta)
         normal_y = math.sin(phi) * math.sin(theta)
@@ -54,19 +72,26 @@ def create_training_orientations(object_path):
                                                                    normal_z],
                                                                   [0, 0, -1])
 
-        mesh.apply_transform(trimesh.transformations.rotation_matrix(rot_angle,
-                                                                     rot_vec))
+        rotation = trimesh.transformations.rotation_matrix(rot_angle, rot_vec)
+        rotations = np.dot(rotation, rotations)
 
         export_path = folder_path + '/orientation_' + str(i) + ".obj"
-        mesh.export(export_path)
+        mesh.transformed(rotations).export(export_path)
+        poses['orientation_' + str(i)] = np.dot(rotations, to_origin)
+
+    write_pose_sidecar(object_path, folder_path, poses)
+
+
+def mesh_files(path):
+    """meshes of a folder in any format trimesh reads, see find_meshes"""
+    return [path + filename for filename in find_meshes(path).values()]
 
 
-path = "path/to/models/"
+if __name__ == "__main__":
+    path = "path/to/models/"
 
-filelist = []
-for filename in os.listdir(path):
-    filelist.append(path + filename)
+    filelist = mesh_files(path)
 
-for file_path in filelist:
-    print('Currently the object ', file_path, ' is processed.')
-    create_training_orientations(file_path)
+    for file_path in filelist:
+        print('Currently the object ', file_path, ' is processed.')
+        create_training_orientations(file_path)
@@ -0,0 +1,146 @@
+"""Array-backed triangle mesh for the orientation scripts.
+
+trimesh.Trimesh objects keep caches (adjacency, face normals, bounds, ...)
+that the orientation search never needs, and the hull facets used to be
+kept as nested lists. CompactMesh only holds contiguous vertices and
+int32 faces, and FacetGroups stores the facets of every hull plane in
+CSR layout (offsets into one simplex array). trimesh is only used to read
+and write files, it is imported on first use.
+"""
+import os
+
+import numpy as np
+
+# Meshes are stored with float32 vertices, half the memory of float64.
+# The orientation search loads its mesh with SEARCH_DTYPE: rounded to
+# float32 it chooses other poses (a 64-section cylinder gets 4 instead of
+# 5 orientations), see tests/test_orientations.py
+VERTEX_DTYPE = np.float32
+SEARCH_DTYPE = np.float64
+
+
+class CompactMesh:
+    """vertices (n x 3, VERTEX_DTYPE unless given) and int32 triangle faces
+    (m x 3)"""
+
+    __slots__ = ("vertices", "faces")
+
+    def __init__(self, vertices, faces, dtype=VERTEX_DTYPE):
+        self.vertices = np.ascontiguousarray(vertices, dtype=dtype)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int32)
+
+    @classmethod
+    def from_trimesh(cls, mesh, dtype=VERTEX_DTYPE):
+        return cls(mesh.vertices, mesh.faces, dtype)
+
+    @classmethod
+    def load(cls, path, dtype=VERTEX_DTYPE):
+        import trimesh
+        return cls.from_trimesh(trimesh.load(path), dtype)
+
+    def to_trimesh(self):
+        import trimesh
+        return trimesh.Trimesh(self.vertices, self.faces, process=False)
+
+    def export(self, path):
+        self.to_trimesh().export(path)
+
+    def transformed(self, matrix):
+        """copy of the mesh with a 4x4 transformation applied"""
+        matrix = np.asarray(matrix, dtype=np.float64)
+        vertices = np.dot(self.vertices.astype(np.float64),
+                          matrix[:3, :3].T) + matrix[:3, 3]
+        return CompactMesh(vertices, self.faces, self.vertices.dtype)
+
+    @property
+    def bounds(self):
+        """axis aligned bounding box as [min, max]"""
+        return np.array([self.vertices.min(axis=0),
+                         self.vertices.max(axis=0)])
+
+    @property
+    def center_mass(self):
+        """centroid of the enclosed volume, from the signed volumes of the
+        tetrahedra between the origin and every face"""
+        triangles = self.vertices[self.faces].astype(np.float64)
+        volumes = np.einsum("ij,ij->i", triangles[:, 0],
+                            np.cross(triangles[:, 1], triangles[:, 2]))
+        total = volumes.sum()
+        if total == 0:
+            return triangles.reshape(-1, 3).mean(axis=0)
+        # the centroid of a tetrahedron with one corner in the origin
+        return np.dot(volumes, triangles.sum(axis=1)) / (4. * total)
+
+
+class FacetGroups:
+    """Hull simplices grouped by plane. group(i) = simplices of the
+    rows offsets[i]:offsets[i + 1]"""
+
+    __slots__ = ("offsets", "simplices")
+
+    def __init__(self, offsets, simplices):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.simplices = np.ascontiguousarray(simplices, dtype=np.int32)
+
+    @classmethod
+    def from_labels(cls, labels, simplices, count=None):
+        """group the simplices by their group label, keeping their order
+        within a group"""
+        labels = np.asarray(labels)
+        if count is None:
+            count = int(labels.max()) + 1 if len(labels) else 0
+        order = np.argsort(labels, kind="stable")
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=count), out=offsets[1:])
+        return cls(offsets, np.asarray(simplices)[order])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return self.simplices[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_mesh_to_origin(path, dtype=VERTEX_DTYPE):
+    """Load a mesh and move it into its oriented bounding box at the origin.
+    Returns the mesh and the applied transformation"""
+    import trimesh
+    mesh = trimesh.load(path)
+    to_origin, extents = trimesh.bounds.oriented_bounds(mesh, 1, True, None)
+    vertices = np.dot(mesh.vertices, to_origin[:3, :3].T) + to_origin[:3, 3]
+    return CompactMesh(vertices, mesh.faces, dtype), to_origin
+
+
+def find_meshes(mesh_dir):
+    """model name -> file name of the meshes in mesh_dir, in any format
+    trimesh reads. <model>_base.* is the base mesh written next to an
+    oriented <model> and left out if <model> is there. Of several files of
+    one model the first is used"""
+    import trimesh
+    # longest first, so that x.tar.bz2 is not taken for x.tar in .bz2
+    extensions = sorted(("." + name for name in trimesh.available_formats()),
+                        key=len, reverse=True)
+    meshes = {}
+    for filename in sorted(os.listdir(mesh_dir)):
+        if not os.path.isfile(os.path.join(mesh_dir, filename)):
+            continue
+        extension = next((extension for extension in extensions
+                          if filename.lower().endswith(extension)), None)
+        if extension is None:
+            continue
+        model = filename[:-len(extension)]
+        if model in meshes:
+            print("Found %s and %s for model %s, using %s" % (
+                meshes[model], filename, model, meshes[model]))
+            continue
+        meshes[model] = filename
+    return {model: filename for model, filename in meshes.items()
+            if not (model.endswith("_base") and
+                    model[:-len("_base")] in meshes)}
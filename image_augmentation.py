@@ -1,20 +1,58 @@
 import sys
 import getopt
+import hashlib
+import importlib
+import json
 import os
 import io
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
 
-import cv2
-from matplotlib import pyplot as plt
 import numpy as np
 
-from albumentations import (
-    HorizontalFlip, IAAPerspective, ShiftScaleRotate, CLAHE, RandomRotate90,
-    Transpose, Blur, OpticalDistortion, GridDistortion,
-    HueSaturationValue, IAAAdditiveGaussianNoise, GaussNoise,
-    MotionBlur, MedianBlur, RandomBrightnessContrast, IAAPiecewiseAffine,
-    IAASharpen, IAAEmboss, Flip, OneOf, Compose
+from image_shards import ShardReader, ShardWriter, SHARD_SIZE, is_shard_store
+
+# cv2, matplotlib, albumentations and imgaug take seconds to import, so
+# they are imported by the functions that need them. The names below can
+# still be imported from this module, see __getattr__.
+LAZY_MODULES = {"cv2": "cv2", "plt": "matplotlib.pyplot", "imgaug": "imgaug"}
+ALBUMENTATIONS_TRANSFORMS = (
+    "HorizontalFlip", "IAAPerspective", "ShiftScaleRotate", "CLAHE",
+    "RandomRotate90", "Transpose", "Blur", "OpticalDistortion",
+    "GridDistortion", "HueSaturationValue", "IAAAdditiveGaussianNoise",
+    "GaussNoise", "MotionBlur", "MedianBlur", "RandomBrightnessContrast",
+    "IAAPiecewiseAffine", "IAASharpen", "IAAEmboss", "Flip", "OneOf",
+    "Compose"
 )
 
+_imgaug = False
+
+
+def __getattr__(name):
+    """import the heavy dependencies on first access (PEP 562)"""
+    if name in LAZY_MODULES:
+        value = importlib.import_module(LAZY_MODULES[name])
+    elif name in ALBUMENTATIONS_TRANSFORMS:
+        value = getattr(importlib.import_module("albumentations"), name)
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__,
+                                                                 name))
+    globals()[name] = value
+    return value
+
+
+def optional_imgaug():
+    """the imgaug module, None if it is not installed"""
+    global _imgaug
+    if _imgaug is False:
+        try:
+            import imgaug
+        except ImportError:
+            imgaug = None
+        _imgaug = imgaug
+    return _imgaug
+
 
 READTHEDOCS_TEMPLATE_ALBU = (
     "[{name}](https://albumentations.readthedocs.io/en/" +
@@ -27,17 +65,23 @@ TRANSFORM_NAME_WITH_LINK_TEMPLATE = READTHEDOCS_TEMPLATE_ALBU + \
 IMGAUG_TRANSFORM_NAME_WITH_LINK_TEMPLATE = READTHEDOCS_TEMPLATE_IMGAUG + \
                                            ".imgaug.transforms.{name})"
 
+MANIFEST_NAME = "augmentation_manifest.json"
+IMAGE_DIR = "/save/path"
+
 
 def load_rgb_image(path):
+    import cv2
     img = cv2.imread(path, cv2.IMREAD_COLOR)
     return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 
 def get_figure(height=1080, width=1920, dpi=200):
+    from matplotlib import pyplot as plt
     return plt.figure(figsize=(width / dpi, height / dpi))
 
 
 def figure_to_numpy(figure, dpi=200):
+    import cv2
     buf = io.BytesIO()
     figure.savefig(buf, format="png", dpi=dpi)
     buf.seek(0)
@@ -46,15 +90,7 @@ def figure_to_numpy(figure, dpi=200):
     return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
 
-def apply_transform(
-        image, transform_cls, args, targets=None, nrows=None,
-        ncols=None, height=1080, width=1920, dpi=200
-):
-
-    args = [{"p": 0}] + list(args)
-    targets = targets or {}
-    total = len(args)
-
+def grid_shape(total, nrows=None, ncols=None):
     if nrows is None:
         nrows = total // np.sqrt(total).astype(int)
     if ncols is None:
@@ -63,44 +99,86 @@ def apply_transform(
     if nrows * ncols != total:
         ncols += 1
 
-    nrows, ncols = min(nrows, ncols), max(nrows, ncols)
+    return min(nrows, ncols), max(nrows, ncols)
+
+
+def make_montage(images, labels=None, nrows=None, ncols=None, height=1080,
+                 width=1920, padding=10, label_height=30, background=255):
+    """tile the images into a preallocated RGB canvas of height x width.
+    Every image is scaled to fit its cell, keeping the aspect ratio, and
+    the optional labels are drawn above the images"""
+    import cv2
+    nrows, ncols = grid_shape(len(images), nrows, ncols)
+    if labels is None:
+        label_height = 0
+
+    canvas = np.full((height, width, 3), background, dtype=np.uint8)
+    cell_w = (width - padding * (ncols + 1)) // ncols
+    cell_h = (height - padding * (nrows + 1)) // nrows - label_height
+
+    for i, image in enumerate(images):
+        row, col = divmod(i, ncols)
+        x0 = padding + col * (cell_w + padding)
+        y0 = padding + row * (cell_h + label_height + padding)
+
+        if labels is not None:
+            cv2.putText(canvas, labels[i], (x0, y0 + label_height - 8),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 1,
+                        cv2.LINE_AA)
+        y0 += label_height
+
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        scale = min(cell_w / image.shape[1], cell_h / image.shape[0])
+        w = max(1, int(image.shape[1] * scale))
+        h = max(1, int(image.shape[0] * scale))
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        tile = cv2.resize(image, (w, h), interpolation=interpolation)
+
+        x0 += (cell_w - w) // 2
+        y0 += (cell_h - h) // 2
+        canvas[y0:y0 + h, x0:x0 + w] = tile[..., :3]
+
+    return canvas
+
+
+def apply_transform(
+        image, transform_cls, args, targets=None, nrows=None,
+        ncols=None, height=1080, width=1920, dpi=200
+):
+    """apply the transform with every set of args and tile the results
+    next to the original image. dpi is kept for compatibility, the
+    preview is drawn directly with numpy and cv2"""
+    args = [{"p": 0}] + list(args)
+    targets = targets or {}
 
     result_args = []
-    figure = get_figure(height, width, dpi)
-    figure.tight_layout(pad=0)
+    images = []
+    labels = []
     for i, args_i in enumerate(args, 1):
         if "p" not in args_i:
             args_i["p"] = 1
 
         if i == 1:
-            title = f"{i}. Original"
+            labels.append(f"{i}. Original")
         else:
-            title = f"{i}."
-
-        ax = figure.add_subplot(nrows, ncols, i)
-        ax.set_title(title)
-        ax.axis("off")
-        ax.imshow(transform_cls(**args_i)(image=image, **targets)["image"])
+            labels.append(f"{i}.")
 
+        images.append(transform_cls(**args_i)(image=image, **targets)["image"])
         result_args.append(args_i)
 
-    figure.canvas.draw()
-    plt.axis("off")
-    plt.subplots_adjust(left=0.01, right=0.99, bottom=0.1,
-                        top=0.9, hspace=0.2, wspace=0.01)
-    result_image = figure_to_numpy(figure, dpi)
-    plt.close(figure)
+    result_image = make_montage(images, labels, nrows, ncols, height, width)
 
     return result_args, result_image
 
 
-def save_results(cls, text, image, save_path):
+def save_results(cls, text, image, save_path, image_dir=IMAGE_DIR):
+    import cv2
     with open(save_path, "a") as file:
         file.write("\n\n" + text)
 
     # image_path = os.path.split(save_path)[0]
-    image_path = '/save/path'
-    image_path = os.path.join(image_path, "{cls.__name__}.jpg")
+    image_path = os.path.join(image_dir, f"{cls.__name__}.jpg")
     cv2.imwrite(image_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
 
 
@@ -130,9 +208,10 @@ def create_docs_text(cls, args):
 
 def create_example(
         transform_cls, args, image_path, targets=None, nrows=None,
-        ncols=None, height=1080, width=1920, dpi=200
+        ncols=None, height=1080, width=1920, dpi=200, image=None
 ):
-    image = load_rgb_image(image_path)
+    if image is None:
+        image = load_rgb_image(image_path)
 
     args, image = apply_transform(
         image=image,
@@ -162,73 +241,290 @@ def create_and_save(
         width=1920,
         dpi=200,
         show=False,
+        image=None,
+        image_dir=IMAGE_DIR,
 ):
     text, image = create_example(
         transform_cls, args, image_path, targets=targets,
-        nrows=nrows, ncols=ncols, height=height, width=width, dpi=dpi
+        nrows=nrows, ncols=ncols, height=height, width=width, dpi=dpi,
+        image=image
     )
 
-    save_results(transform_cls, text, image, save_path)
+    save_results(transform_cls, text, image, save_path, image_dir)
+
+
+def create_and_save_all(save_path, catalogue, image_path, height=1080,
+                        width=1920, image_dir=IMAGE_DIR, workers=4):
+    """create the previews of many transforms at once. catalogue is a list
+    of (transform_cls, args) pairs. The image is loaded once and the
+    previews are generated in parallel, the docs text keeps the order of
+    the catalogue"""
+    image = load_rgb_image(image_path)
+
+    def create(entry):
+        transform_cls, args = entry
+        return create_example(transform_cls, args, image_path,
+                              height=height, width=width, image=image)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(create, catalogue))
+
+    for (transform_cls, _), (text, preview) in zip(catalogue, results):
+        save_results(transform_cls, text, preview, save_path, image_dir)
+
+
+def build_pipeline():
+    from albumentations import (
+        Blur, CLAHE, Compose, IAAAdditiveGaussianNoise, OneOf,
+        RandomBrightnessContrast
+    )
+
+    # aug = HorizontalFlip(p=1)
+    # aug = IAAAdditiveGaussianNoise(p=1)
+    # aug = RandomBrightnessContrast(p=1)
+    # aug = Blur(blur_limit=(5, 5),p=1)
+    # aug = CLAHE(p=1)
+    # aug = IAASharpen(p=1)
+    return Compose([OneOf([IAAAdditiveGaussianNoise(p=0.5),
+                           RandomBrightnessContrast(p=0.5)], 0.75),
+                   OneOf([Blur(blur_limit=(5, 5),
+                               p=0.5), CLAHE(p=0.5)], 0.75)])
+
+
+def augment_image(image, aug=None):
+    if aug is None:
+        aug = build_pipeline()
+    image = aug(image=image)['image']
+    # aug2 = CLAHE(p=1)
+    # image = aug2(image=image)['image']
+    return image
+
+
+def decode_rgb_image(data):
+    import cv2
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def encode_png(image):
+    import cv2
+    return cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1]
+
+
+def pipeline_fingerprint(aug, seed=None):
+    """hash of the augmentation config and seed, stored in the manifest"""
+    config = re.sub(r" at 0x[0-9a-fA-F]+", "", repr(aug))
+    return hashlib.sha1((config + repr(seed)).encode()).hexdigest()
+
+
+def seed_image(seed, name):
+    """derive the random state of one image from the seed and its name,
+    so the result does not depend on which images are processed in a run"""
+    if seed is None:
+        return
+    digest = hashlib.sha1(("%s:%s" % (seed, name)).encode()).hexdigest()
+    image_seed = int(digest[:8], 16)
+    random.seed(image_seed)
+    np.random.seed(image_seed)
+    imgaug = optional_imgaug()
+    if imgaug is not None:
+        imgaug.seed(image_seed)
+
+
+def load_manifest(outputpath):
+    path = os.path.join(outputpath, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(outputpath, manifest):
+    path = os.path.join(outputpath, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def source_signature(path=None, data=None, check='mtime'):
+    """signature of a source image, from its mtime and size or its content"""
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+    if check == 'hash':
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    stat = os.stat(path)
+    return "%d:%d" % (stat.st_mtime_ns, stat.st_size)
+
+
+def is_current(manifest, name, signature, fingerprint):
+    return manifest.get(name) == [signature, fingerprint]
+
+
+def augment_shards(inputpath, shard_writer, aug, seed=None, manifest=None,
+                   fingerprint=None, existing=()):
+    """augment all images of a shard store, streaming shard by shard"""
+    skipped = 0
+    with ShardReader(inputpath) as reader:
+        for name, data in reader:
+            if name.find('.png') == -1:
+                print('wrong file type')
+                continue
+            if manifest is not None:
+                signature = source_signature(data=data)
+                if name in existing and is_current(manifest, name,
+                                                   signature, fingerprint):
+                    skipped += 1
+                    continue
+            seed_image(seed, name)
+            image = augment_image(decode_rgb_image(data), aug)
+            shard_writer.write(name, encode_png(image).tobytes())
+            if manifest is not None:
+                manifest[name] = [signature, fingerprint]
+    print("Skipped %d up to date images" % skipped)
+
+
+def augment_folder(inputpath, outputpath, dirname, aug, shard_writer=None,
+                   seed=None, manifest=None, fingerprint=None, check='mtime',
+                   existing=()):
+    """augment all images of one class folder. If a manifest is given,
+    images whose source and pipeline did not change are skipped"""
+    import cv2
+    skipped = 0
+    for filename in os.listdir(inputpath + dirname):
+        whole_path = inputpath + dirname + '/' + filename
+        if(whole_path.find('.png') == -1):
+            print('wrong file type')
+            continue
+
+        name = dirname + '/' + filename
+        if manifest is not None:
+            signature = source_signature(whole_path, check=check)
+            if shard_writer is not None:
+                exists = name in existing
+            else:
+                exists = os.path.isfile(outputpath + name)
+            if exists and is_current(manifest, name, signature, fingerprint):
+                skipped += 1
+                continue
+
+        seed_image(seed, name)
+        image = load_rgb_image(whole_path)
+        image = augment_image(image, aug)
+
+        if shard_writer is not None:
+            shard_writer.write(name, encode_png(image).tobytes())
+        else:
+            cv2.imwrite(outputpath + name,
+                        cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        if manifest is not None:
+            manifest[name] = [signature, fingerprint]
+    if skipped > 0:
+        print("Skipped %d up to date images in %s" % (skipped, dirname))
 
 
 def main(argv):
+    usage = ('example.py -i <inputfile> -o <outputfile> '
+             '[--shards] [--shard-size <images per shard>] [--seed <seed>] '
+             '[--incremental] [--check <mtime|hash>]')
     try:
-        opts, args = getopt.getopt(argv, "hi:o:", ["ifile=", "ofile="])
+        opts, args = getopt.getopt(argv, "hi:o:", ["ifile=", "ofile=",
+                                                   "shards", "shard-size=",
+                                                   "seed=", "incremental",
+                                                   "check="])
     except getopt.GetoptError:
-        print('example.py -i <inputfile> -o <outputfile>')
+        print(usage)
         sys.exit(2)
+    use_shards = False
+    shard_size = SHARD_SIZE
+    seed = None
+    incremental = False
+    check = 'mtime'
     for opt, arg in opts:
         if opt == '-h':
-            print('example.py -i <inputfile> -o <outputfile>')
+            print(usage)
             sys.exit()
         elif opt in ("-i", "--ifile"):
             inputpath = arg
         elif opt in ("-o", "--ofile"):
             outputpath = arg
+        elif opt == "--shards":
+            use_shards = True
+        elif opt == "--shard-size":
+            shard_size = int(arg)
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--incremental":
+            incremental = True
+        elif opt == "--check":
+            if arg not in ('mtime', 'hash'):
+                print(usage)
+                sys.exit(2)
+            check = arg
     print('Input file is ', inputpath)
     print('Output file is ', outputpath)
 
-    try:
-        os.mkdir(outputpath)
-    except OSError:
-        print("Folder %s already exists " % outputpath)
-    else:
-        print("Successfully created the directory %s " % outputpath)
-
-    for dirnames in os.listdir(inputpath):
-        print("Current name is: ", inputpath + dirnames)
-        if (os.path.isdir(inputpath + dirnames)):
-            dirname_new = dirnames
+    aug = build_pipeline()
+    fingerprint = pipeline_fingerprint(aug, seed)
+
+    # with --incremental, the manifest maps every output image to the
+    # signature of its source image and the pipeline fingerprint
+    manifest = None
+    existing = set()
+    if incremental:
+        manifest = load_manifest(outputpath)
+        if use_shards and is_shard_store(outputpath):
+            with ShardReader(outputpath) as reader:
+                existing = set(reader.index)
+
+    shard_writer = None
+    if use_shards:
+        # images are written to shards in outputpath instead of single files
+        shard_writer = ShardWriter(outputpath, shard_size)
+
+    if is_shard_store(inputpath):
+        if shard_writer is None:
+            print('Shard input requires --shards output')
+            sys.exit(2)
+        augment_shards(inputpath, shard_writer, aug, seed, manifest,
+                       fingerprint, existing)
+        shard_writer.close()
+        if manifest is not None:
+            save_manifest(outputpath, manifest)
+        return
+
+    if shard_writer is None:
         try:
-            os.mkdir(outputpath + dirname_new)
+            os.mkdir(outputpath)
         except OSError:
-            print("Folder %s already exists " % outputpath + dirname_new)
+            print("Folder %s already exists " % outputpath)
         else:
-            print("Successfully created the directory %s " % outputpath +
-                  dirname_new)
-        for filename in os.listdir(inputpath + dirnames):
-            whole_path = inputpath + dirnames + '/' + filename
-            if(whole_path.find('.png') != -1):
-                image = load_rgb_image(inputpath + dirnames + '/' + filename)
-
-                # aug = HorizontalFlip(p=1)
-                # aug = IAAAdditiveGaussianNoise(p=1)
-                # aug = RandomBrightnessContrast(p=1)
-                # aug = Blur(blur_limit=(5, 5),p=1)
-                # aug = CLAHE(p=1)
-                # aug = IAASharpen(p=1)
-                aug = Compose([OneOf([IAAAdditiveGaussianNoise(p=0.5),
-                                      RandomBrightnessContrast(p=0.5)], 0.75),
-                              OneOf([Blur(blur_limit=(5, 5),
-                                          p=0.5), CLAHE(p=0.5)], 0.75)])
-                image = aug(image=image)['image']
-                # aug2 = CLAHE(p=1)
-                # image = aug2(image=image)['image']
-
-                cv2.imwrite(outputpath + dirname_new + '/' + filename,
-                            cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+            print("Successfully created the directory %s " % outputpath)
+
+    for dirnames in os.listdir(inputpath):
+        print("Current name is: ", inputpath + dirnames)
+        # files next to the class folders (e.g. the manifest) are no
+        # classes, they must not augment the previous folder again
+        if not os.path.isdir(inputpath + dirnames):
+            continue
+        dirname_new = dirnames
+        if shard_writer is None:
+            try:
+                os.mkdir(outputpath + dirname_new)
+            except OSError:
+                print("Folder %s already exists " % outputpath + dirname_new)
             else:
-                print('wrong file type')
+                print("Successfully created the directory %s " % outputpath +
+                      dirname_new)
+        augment_folder(inputpath, outputpath, dirname_new, aug, shard_writer,
+                       seed, manifest, fingerprint, check, existing)
+        if manifest is not None and shard_writer is None:
+            save_manifest(outputpath, manifest)
+
+    if shard_writer is not None:
+        shard_writer.close()
+    if manifest is not None:
+        save_manifest(outputpath, manifest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+"""Sharded storage for rendered and augmented images.
+
+Instead of writing one PNG per view, images are appended to fixed-size,
+uncompressed tar shards. Every writer keeps a JSON index next to its shards
+which maps an image name (e.g. "model/model_0001_001.png") to the shard file,
+the byte offset of the image data and its size. Single images can therefore
+be read back with one seek, and whole shards can be streamed sequentially.
+The shards are plain tar files, so they can still be unpacked with ``tar``.
+
+Several writers (e.g. several render processes) may write into the same
+directory, each with its own prefix. The reader merges all indices in prefix
+order, so an image written by a later run replaces the one of an earlier run.
+"""
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+SHARD_SIZE = 10000  # images per shard
+INDEX_SUFFIX = '.index.json'
+SHARD_SUFFIX = '.tar'
+
+
+def default_prefix():
+    """prefix for a new writer, sorting after all earlier writers"""
+    return '%s-%d' % (time.strftime('%Y%m%d%H%M%S'), os.getpid())
+
+
+def is_shard_store(path):
+    """check if a directory contains image shards"""
+    if not os.path.isdir(path):
+        return False
+    return any(name.endswith(INDEX_SUFFIX) or name.endswith(SHARD_SUFFIX)
+               for name in os.listdir(path))
+
+
+def _padded_size(size):
+    """size of a tar member's data including the padding to full blocks"""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class ShardWriter:
+    """Append images to tar shards of at most shard_size images each"""
+
+    def __init__(self, root, shard_size=SHARD_SIZE, prefix=None):
+        self.root = root
+        self.shard_size = shard_size
+        self.prefix = prefix or default_prefix()
+        # name -> [shard file name, data offset, data size]
+        self.index = {}
+        self._tar = None
+        self._shard_name = None
+        self._shard_number = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open_next_shard(self):
+        self._close_shard()
+        self._shard_name = '%s_%06d%s' % (self.prefix, self._shard_number,
+                                         SHARD_SUFFIX)
+        self._shard_number += 1
+        self._count = 0
+        self._tar = tarfile.open(os.path.join(self.root, self._shard_name),
+                                 'w', format=tarfile.PAX_FORMAT)
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+            self._write_index()
+
+    def _write_index(self):
+        path = os.path.join(self.root, self.prefix + INDEX_SUFFIX)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(path + '.tmp', path)
+
+    def write(self, name, data):
+        """append the encoded image data under the given name"""
+        with self._lock:
+            if self._tar is None or self._count >= self.shard_size:
+                self._open_next_shard()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self._tar.addfile(info, io.BytesIO(data))
+            # after addfile the tar offset points behind the padded data
+            offset = self._tar.offset - _padded_size(info.size)
+            self.index[name] = [self._shard_name, offset, info.size]
+            self._count += 1
+
+    def write_file(self, name, path):
+        """append the content of an existing image file"""
+        with open(path, 'rb') as f:
+            self.write(name, f.read())
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+
+
+class ShardReader:
+    """Random access and sequential reads of all shards in a directory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+        indexed_shards = set()
+        for name in sorted(os.listdir(root)):
+            if name.endswith(INDEX_SUFFIX):
+                with open(os.path.join(root, name)) as f:
+                    index = json.load(f)
+                self.index.update(index)
+                indexed_shards.update(entry[0] for entry in index.values())
+        # shards of a writer that did not finish have no index entry yet
+        for name in sorted(os.listdir(root)):
+            if name.endswith(SHARD_SUFFIX) and name not in indexed_shards:
+                self.index.update(self._scan_shard(name))
+
+    def _scan_shard(self, shard_name):
+        index = {}
+        path = os.path.join(self.root, shard_name)
+        file_size = os.path.getsize(path)
+        try:
+            with tarfile.open(path) as tar:
+                for info in tar:
+                    # the data of the last member may be cut off
+                    if (info.isfile() and
+                            info.offset_data + info.size <= file_size):
+                        index[info.name] = [shard_name, info.offset_data,
+                                            info.size]
+        except (tarfile.ReadError, EOFError):
+            print('Shard %s is truncated, using %d images' % (shard_name,
+                                                             len(index)))
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return sorted(self.index)
+
+    def read(self, name):
+        """encoded data of a single image"""
+        shard_name, offset, size = self.index[name]
+        with self._lock:
+            f = self._files.get(shard_name)
+            if f is None:
+                f = open(os.path.join(self.root, shard_name), 'rb')
+                self._files[shard_name] = f
+            f.seek(offset)
+            return f.read(size)
+
+    def __iter__(self):
+        """stream (name, data) of all images, shard by shard in file order"""
+        by_shard = {}
+        for name, (shard_name, offset, size) in self.index.items():
+            by_shard.setdefault(shard_name, []).append((offset, size, name))
+        for shard_name in sorted(by_shard):
+            with open(os.path.join(self.root, shard_name), 'rb') as f:
+                for offset, size, name in sorted(by_shard[shard_name]):
+                    f.seek(offset)
+                    yield name, f.read(size)
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
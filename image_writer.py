@@ -0,0 +1,149 @@
+"""Asynchronous writing of rendered images.
+
+Blender's save_render encodes and writes the PNG on the render thread, so
+the next render waits for the compression and the (network) file system.
+AsyncImageWriter takes a copy of the pixel buffer instead and converts,
+encodes and writes it in a pool of background threads. At most queue_size
+images wait for a writer, so the memory stays bounded: submit blocks
+while the queue is full.
+
+Images are written as PNG with a configurable zlib level (0 = stored,
+uncompressed) or as raw .npy arrays, either to files or to the shards of an
+image_shards.ShardWriter.
+
+The module is imported by phong_multi_for_rotnet.py inside Blender, so it
+only uses the standard library, NumPy and no syntax newer than Python 3.5.
+"""
+import io
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+PNG_LEVEL = 6
+WORKERS = 4
+QUEUE_SIZE = 16
+FORMATS = ('png', 'npy')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types by number of channels
+PNG_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+
+
+def linear_to_srgb(linear):
+    """sRGB transfer function, the 'Standard' view transform of Blender"""
+    linear = numpy.clip(linear, 0., 1.)
+    return numpy.where(linear <= 0.0031308, linear * 12.92,
+                       1.055 * numpy.power(linear, 1 / 2.4) - 0.055)
+
+
+def to_display(pixels, channels=4):
+    """Convert a float RGBA buffer of Blender (height x width x 4, linear,
+    bottom row first) to an 8 bit image (top row first) with 1 (gray),
+    3 (RGB) or 4 (RGBA) channels"""
+    pixels = numpy.asarray(pixels, dtype=numpy.float32)[::-1]
+    rgb = linear_to_srgb(pixels[..., :3])
+    if channels == 1:
+        rgb = numpy.dot(rgb, [0.2126, 0.7152, 0.0722])[..., None]
+    elif channels == 4:
+        rgb = numpy.concatenate([rgb, numpy.clip(pixels[..., 3:4], 0., 1.)],
+                                axis=2)
+    return numpy.ascontiguousarray(
+        numpy.round(rgb * 255).astype(numpy.uint8))
+
+
+def _png_chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+
+def encode_png(image, level=PNG_LEVEL):
+    """PNG of an 8 bit image (height x width x channels) with zlib level
+    0 to 9, every row uses filter type 0"""
+    if image.ndim == 2:
+        image = image[..., None]
+    height, width, channels = image.shape
+    rows = numpy.zeros((height, width * channels + 1), dtype=numpy.uint8)
+    rows[:, 1:] = image.reshape(height, -1)
+    header = struct.pack('>IIBBBBB', width, height, 8,
+                         PNG_COLOR_TYPES[channels], 0, 0, 0)
+    return (PNG_SIGNATURE + _png_chunk(b'IHDR', header) +
+            _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) +
+            _png_chunk(b'IEND', b''))
+
+
+def encode_npy(image):
+    buffer = io.BytesIO()
+    numpy.save(buffer, image)
+    return buffer.getvalue()
+
+
+class AsyncImageWriter:
+    """Encode and write images in background threads"""
+
+    def __init__(self, image_format='png', level=PNG_LEVEL, channels=4,
+                 shard_writer=None, workers=WORKERS, queue_size=QUEUE_SIZE):
+        if image_format not in FORMATS:
+            raise ValueError('unknown image format %s' % image_format)
+        self.image_format = image_format
+        self.level = level
+        self.channels = channels
+        self.shard_writer = shard_writer
+        self.written = 0
+        self._errors = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor = ThreadPoolExecutor(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, image_dir, name, pixels):
+        """Queue a float RGBA buffer as returned by Blender (the caller must
+        not modify it afterwards). Blocks while queue_size images are
+        waiting and raises the error of a failed write"""
+        if self._errors:
+            raise self._errors[0]
+        self._slots.acquire()
+        future = self._executor.submit(self._write, image_dir, name, pixels)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._slots.release()
+        with self._lock:
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+            else:
+                self.written += 1
+
+    def _write(self, image_dir, name, pixels):
+        image = to_display(pixels, self.channels)
+        if self.image_format == 'png':
+            data = encode_png(image, self.level)
+        else:
+            data = encode_npy(image)
+        filename = name + '.' + self.image_format
+
+        if self.shard_writer is not None:
+            self.shard_writer.write(os.path.basename(image_dir) + '/' +
+                                    filename, data)
+        else:
+            os.makedirs(image_dir, exist_ok=True)
+            # a file with the final name is always complete
+            path = os.path.join(image_dir, filename)
+            tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def close(self):
+        """wait until all queued images are written"""
+        self._executor.shutdown(wait=True)
+        if self._errors:
+            raise self._errors[0]
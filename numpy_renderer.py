@@ -0,0 +1,348 @@
+"""Headless renderer without Blender.
+
+Renders flat Lambert shaded views of a single white part with a vectorized
+NumPy z-buffer rasteriser. The camera model (distance 2, theta/phi, 5.5 mm
+'PERSP' lens, tracking the origin), the centering and normalisation of the
+model and the file naming are the same as in phong_multi_for_rotnet.py:
+
+python numpy_renderer.py <3d mesh list file> <save dir rotnet> -i <input dir>
+
+With --compare <reference dir>, the renders are checked against reference
+renders of the Blender renderer with the same names, e.g. after changes of
+the renderer:
+
+python numpy_renderer.py <3d mesh list file> <save dir> --compare <ref dir>
+"""
+import sys
+import getopt
+import math
+import os
+
+import cv2
+import numpy as np
+import trimesh
+
+import render_common
+from image_shards import ShardWriter, SHARD_SIZE
+from render_common import (
+    camera_location, get_rot_num, orientation_path, rename_orientations,
+    view_coords, view_name
+)
+
+# output image size = (W, H)
+WIDTH = 500
+HEIGHT = 500
+SUPERSAMPLE = 2
+
+# headlight from the camera plus some ambient light, on a white background
+AMBIENT = 0.2
+DIFFUSE = 0.8
+BACKGROUND = 255
+
+NEAR = 1e-3
+MAX_FRAGMENTS = 1 << 22
+
+# minimal silhouette overlap with a reference render
+MIN_SILHOUETTE_IOU = 0.95
+
+
+def load_normalized_mesh(path):
+    """vertices and faces of a mesh, centered and scaled like
+    center_model and normalize_model do in blender"""
+    mesh = trimesh.load(path, force='mesh')
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    faces = np.asarray(mesh.faces, dtype=np.int64)
+    return normalize_vertices(vertices), faces
+
+
+def normalize_vertices(vertices):
+    lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+    vertices = vertices - (lower + upper) / 2
+    size = (upper - lower).max()
+    if size > 0:
+        vertices = vertices / size
+    return vertices
+
+
+def camera_basis(location):
+    """right, up and forward axis of a camera at location, tracking the
+    origin with its up axis towards +z (Track To, -Z and UP_Y)"""
+    forward = -np.asarray(location, dtype=np.float64)
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, (0., 0., 1.))
+    if np.linalg.norm(right) < 1e-9:
+        # looking straight down or up, the up axis is undefined
+        right = np.array((1., 0., 0.))
+    right /= np.linalg.norm(right)
+    up = np.cross(right, forward)
+    return right, up, forward
+
+
+def project(vertices, coord, width, height):
+    """pixel coordinates and depth of the vertices for the camera at coord"""
+    location = np.array(camera_location(coord))
+    right, up, forward = camera_basis(location)
+    relative = vertices - location
+    depth = relative @ forward
+    focal = render_common.CAMERA_LENS / render_common.SENSOR_WIDTH * max(
+        width, height)
+    safe_depth = np.maximum(depth, NEAR)
+    x = width / 2 + focal * (relative @ right) / safe_depth
+    y = height / 2 - focal * (relative @ up) / safe_depth
+    return np.stack((x, y), axis=1), depth
+
+
+def rasterize(screen, depth, faces, width, height):
+    """index of the visible face for every pixel, -1 for the background"""
+    face_buffer = np.full(width * height, -1, dtype=np.int64)
+    z_buffer = np.full(width * height, np.inf)
+
+    tri = screen[faces]
+    tri_depth = depth[faces]
+    visible = (tri_depth > NEAR).all(axis=1)
+
+    # edge function coefficients, oriented so that the inside is positive
+    x0, y0 = tri[:, 0, 0], tri[:, 0, 1]
+    x1, y1 = tri[:, 1, 0], tri[:, 1, 1]
+    x2, y2 = tri[:, 2, 0], tri[:, 2, 1]
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    visible &= np.abs(area) > 1e-12
+
+    # pixel centers (i + 0.5) inside the bounding box of each triangle
+    x_min = np.maximum(np.ceil(tri[:, :, 0].min(axis=1) - 0.5), 0)
+    x_max = np.minimum(np.floor(tri[:, :, 0].max(axis=1) - 0.5), width - 1)
+    y_min = np.maximum(np.ceil(tri[:, :, 1].min(axis=1) - 0.5), 0)
+    y_max = np.minimum(np.floor(tri[:, :, 1].max(axis=1) - 0.5), height - 1)
+    nx = np.where(visible, x_max - x_min + 1, 0).clip(min=0).astype(np.int64)
+    ny = np.where(visible, y_max - y_min + 1, 0).clip(min=0).astype(np.int64)
+    counts = nx * ny
+
+    candidates = np.nonzero(counts)[0]
+    # split into chunks of bounded fragment count
+    chunk_ends = np.cumsum(counts[candidates]) // MAX_FRAGMENTS
+    for chunk in np.split(candidates,
+                          np.nonzero(np.diff(chunk_ends))[0] + 1):
+        if len(chunk) == 0:
+            continue
+        chunk_counts = counts[chunk]
+        ids = np.repeat(chunk, chunk_counts)
+        starts = np.cumsum(chunk_counts) - chunk_counts
+        local = np.arange(chunk_counts.sum()) - np.repeat(starts,
+                                                          chunk_counts)
+        px = x_min[ids] + local % nx[ids]
+        py = y_min[ids] + local // nx[ids]
+        cx, cy = px + 0.5, py + 0.5
+
+        a = area[ids]
+        w0 = ((x1[ids] - cx) * (y2[ids] - cy) -
+              (x2[ids] - cx) * (y1[ids] - cy)) / a
+        w1 = ((x2[ids] - cx) * (y0[ids] - cy) -
+              (x0[ids] - cx) * (y2[ids] - cy)) / a
+        w2 = 1. - w0 - w1
+        inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+        ids, w0, w1, w2 = ids[inside], w0[inside], w1[inside], w2[inside]
+        pixel = (py[inside] * width + px[inside]).astype(np.int64)
+        # perspective correct depth
+        d = tri_depth[ids]
+        z = 1. / (w0 / d[:, 0] + w1 / d[:, 1] + w2 / d[:, 2])
+
+        # nearest fragment per pixel
+        order = np.lexsort((z, pixel))
+        pixel, z, ids = pixel[order], z[order], ids[order]
+        first = np.ones(len(pixel), dtype=bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+        pixel, z, ids = pixel[first], z[first], ids[first]
+
+        closer = z < z_buffer[pixel]
+        z_buffer[pixel[closer]] = z[closer]
+        face_buffer[pixel[closer]] = ids[closer]
+
+    return face_buffer.reshape(height, width)
+
+
+def shade(vertices, faces, coord):
+    """flat Lambert intensity of every face for a headlight at the camera"""
+    tri = vertices[faces]
+    normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    normals /= np.where(lengths > 0, lengths, 1)[:, None]
+    light = -camera_basis(camera_location(coord))[2]
+    # two-sided lighting as in blender internal
+    return AMBIENT + DIFFUSE * np.abs(normals @ light)
+
+
+def render_view(vertices, faces, coord, width=WIDTH, height=HEIGHT,
+                supersample=SUPERSAMPLE):
+    """RGB image of the normalized mesh seen from coord = (theta, phi)"""
+    w, h = width * supersample, height * supersample
+    screen, depth = project(vertices, coord, w, h)
+    face_buffer = rasterize(screen, depth, faces, w, h)
+
+    intensity = np.append(shade(vertices, faces, coord) * 255, BACKGROUND)
+    image = intensity[face_buffer]
+    if supersample > 1:
+        image = image.reshape(height, supersample,
+                              width, supersample).mean(axis=(1, 3))
+    image = np.clip(np.round(image), 0, 255).astype(np.uint8)
+    return np.repeat(image[:, :, None], 3, axis=2)
+
+
+def save(image_dir, name, image, shard_writer=None):
+    data = cv2.imencode('.png', image)[1].tobytes()
+    if shard_writer is not None:
+        shard_writer.write(os.path.basename(image_dir) + '/' + name + '.png',
+                           data)
+        return
+
+    os.makedirs(image_dir, exist_ok=True)
+    path = os.path.join(image_dir, name + '.png')
+    with open(path, 'wb') as f:
+        f.write(data)
+    print('save to ' + path)
+
+
+def render_model(model_name, save_dir_rotnet, input_dir,
+                 variable_angle=False, supersample=SUPERSAMPLE,
+                 shard_writer=None):
+    """Render all orientations of a model like render_model in
+    phong_multi_for_rotnet.py. The orientation files are used in their own
+    coordinates, which is what blender renders after the import axis
+    conversion was undone by rotating the object by -90 degrees."""
+    print("Input dir is: ", input_dir)
+    rot_num, rot_step_size, full_path, num_orient = get_rot_num(model_name,
+                                                                input_dir)
+    image_subdir_rotnet = os.path.join(save_dir_rotnet, model_name)
+    counter = 0
+    rot_num = math.ceil(rot_num)
+
+    rename_orientations(model_name, full_path)
+
+    for k in range(0, num_orient):
+        full_file_path = orientation_path(full_path, model_name, k)
+        print(full_file_path)
+
+        cc1 = 0
+        if os.path.isfile(full_file_path):
+            vertices, faces = load_normalized_mesh(full_file_path)
+            for j in range(0, rot_num):
+                cc1 = cc1 + 1
+                rot = j * rot_step_size
+                for cc, c in enumerate(view_coords(rot, variable_angle), 1):
+                    image = render_view(vertices, faces, c,
+                                        supersample=supersample)
+                    save(image_subdir_rotnet,
+                         view_name(model_name, cc1 + counter, cc), image,
+                         shard_writer)
+
+        counter = counter + cc1
+
+
+def image_similarity(reference, image):
+    """PSNR and overlap (IoU) of the object silhouettes of two BGR renders.
+    The silhouette is every pixel that differs from the corner color"""
+    reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY).astype(np.int16)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.int16)
+    if reference.shape != image.shape:
+        image = cv2.resize(image.astype(np.uint8),
+                           reference.shape[::-1]).astype(np.int16)
+
+    mse = np.mean((reference - image) ** 2)
+    psnr = float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+    silhouette_ref = np.abs(reference - reference[0, 0]) > 8
+    silhouette = np.abs(image - image[0, 0]) > 8
+    union = np.logical_or(silhouette_ref, silhouette).sum()
+    intersection = np.logical_and(silhouette_ref, silhouette).sum()
+    iou = 1. if union == 0 else intersection / union
+    return psnr, float(iou)
+
+
+def compare_renders(reference_dir, save_dir, min_iou=MIN_SILHOUETTE_IOU):
+    """compare all renders in save_dir with the references of the same
+    name. Returns the names of the renders that do not match"""
+    failed = []
+    for root, _, filenames in os.walk(reference_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith('.png'):
+                continue
+            relative = os.path.relpath(os.path.join(root, filename),
+                                       reference_dir)
+            path = os.path.join(save_dir, relative)
+            if not os.path.isfile(path):
+                print('Missing render ' + relative)
+                failed.append(relative)
+                continue
+            reference = cv2.imread(os.path.join(root, filename))
+            psnr, iou = image_similarity(reference, cv2.imread(path))
+            print('%s: PSNR %.1f dB, silhouette IoU %.3f' % (relative, psnr,
+                                                             iou))
+            if iou < min_iou:
+                failed.append(relative)
+    return failed
+
+
+def main(argv):
+    usage = ('numpy_renderer.py <3d mesh list file> <save dir rotnet> '
+             '[-i <input dir>] [--variable-angle] [--supersample <factor>] '
+             '[--shards] [--shard-size <images per shard>] '
+             '[--compare <reference dir>]')
+    try:
+        opts, args = getopt.gnu_getopt(argv, "hi:", ["variable-angle",
+                                                 "supersample=", "shards",
+                                                 "shard-size=", "compare="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    if len(args) != 2:
+        print(usage)
+        sys.exit(2)
+
+    models_list, save_dir_rotnet = args
+    input_dir = os.path.dirname(os.path.abspath(models_list))
+    variable_angle = False
+    supersample = SUPERSAMPLE
+    use_shards = False
+    shard_size = SHARD_SIZE
+    reference_dir = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt == '-i':
+            input_dir = arg
+        elif opt == '--variable-angle':
+            variable_angle = True
+        elif opt == '--supersample':
+            supersample = int(arg)
+        elif opt == '--shards':
+            use_shards = True
+        elif opt == '--shard-size':
+            shard_size = int(arg)
+        elif opt == '--compare':
+            reference_dir = arg
+
+    shard_writer = None
+    if use_shards:
+        shard_writer = ShardWriter(save_dir_rotnet, shard_size)
+
+    with open(models_list) as f:
+        models = f.read().splitlines()
+
+    for model in models:
+        render_model(model, save_dir_rotnet, input_dir, variable_angle,
+                     supersample, shard_writer)
+
+    if shard_writer is not None:
+        shard_writer.close()
+
+    if reference_dir is not None:
+        failed = compare_renders(reference_dir, save_dir_rotnet)
+        if failed:
+            print('%d renders differ from the references' % len(failed))
+            sys.exit(1)
+        print('All renders match the references')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
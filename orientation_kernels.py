@@ -0,0 +1,309 @@
+"""Compiled kernels for calculate_physically_sound_orientations.py.
+
+Two loops of the orientation search can not be vectorized without
+changing their results: the grouping of the hull facets into planes (a
+facet joins the first earlier plane within AREA_COMBINE_THRESHOLD) and the
+stability check (the first facet that contains the projected center of
+mass). With numba installed, they are compiled here and used by the
+orientation script. Without numba, ENABLED is False and the script keeps
+its pure Python implementation. numba itself is only imported when a
+kernel is called for the first time.
+
+python orientation_kernels.py [-n <hull points,...>] [-r <repeats>] \
+    [mesh ...]
+
+checks that both implementations give the same planes and stability
+results for random hulls (and the given meshes), with float64 and float32
+points, and reports the speedup for random hulls of every size of -n.
+"""
+import sys
+import getopt
+import functools
+import importlib.util
+import math
+import time
+
+import numpy as np
+
+from compact_mesh import FacetGroups
+
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+ENABLED = HAVE_NUMBA
+
+POINTS = 400
+# random hulls of about 660, 1500 and 2700 facets
+BENCHMARK_POINTS = (400, 1000, 2000)
+REPEATS = 3
+PARITY_SEEDS = range(5)
+PARITY_DTYPES = (np.float64, np.float32)
+# The search passes float64 points (its mesh is loaded with SEARCH_DTYPE
+# and stability_check casts), float32 is checked for other callers of the
+# kernels. Relative tolerance of the plane areas: in float32 the python
+# area(), which sums cross products of the corner positions, is off by up
+# to 6e-5 on the random hulls (the kernels by 5e-6)
+AREA_RTOL = {np.dtype(np.float64): 1e-9, np.dtype(np.float32): 1e-4}
+
+
+def _jit(function):
+    """compile function with numba when it is called the first time"""
+    if not HAVE_NUMBA:
+        return function
+
+    @functools.wraps(function)
+    def kernel(*args):
+        if kernel.compiled is None:
+            import numba
+            # divisions by zero give inf and nan like in numpy
+            kernel.compiled = numba.njit(cache=True,
+                                         error_model="numpy")(function)
+        return kernel.compiled(*args)
+    kernel.compiled = None
+    return kernel
+
+
+@_jit
+def group_facets(normals, threshold):
+    """Label every facet with its plane, the first earlier plane whose
+    normal is less than threshold (radians) away, or a new plane. Returns
+    the labels and the facet defining the normal of every plane"""
+    n = normals.shape[0]
+    labels = np.empty(n, dtype=np.int32)
+    firsts = np.empty(n, dtype=np.int64)
+    lengths = np.empty(n)
+    for i in range(n):
+        lengths[i] = math.sqrt(normals[i, 0] * normals[i, 0] +
+                               normals[i, 1] * normals[i, 1] +
+                               normals[i, 2] * normals[i, 2])
+    count = 0
+    for i in range(n):
+        label = -1
+        for j in range(count):
+            f = firsts[j]
+            dot = (normals[i, 0] * normals[f, 0] +
+                   normals[i, 1] * normals[f, 1] +
+                   normals[i, 2] * normals[f, 2])
+            cos = min(max(dot / (lengths[i] * lengths[f]), -1.0), 1.0)
+            if math.acos(cos) < threshold:
+                label = j
+                break
+        if label < 0:
+            firsts[count] = i
+            label = count
+            count += 1
+        labels[i] = label
+    return labels, firsts[:count].copy()
+
+
+@_jit
+def first_stable_simplex(pts, simplices, center):
+    """index of the first simplex that contains the x-y projection of
+    center (barycentric coordinates >= 0), -1 if there is none"""
+    for k in range(simplices.shape[0]):
+        a = simplices[k, 0]
+        b = simplices[k, 1]
+        c = simplices[k, 2]
+        det = ((pts[b, 1] - pts[c, 1]) * (pts[a, 0] - pts[c, 0]) +
+               (pts[c, 0] - pts[b, 0]) * (pts[a, 1] - pts[c, 1]))
+        alpha = ((pts[b, 1] - pts[c, 1]) * (center[0] - pts[c, 0]) +
+                 (pts[c, 0] - pts[b, 0]) * (center[1] - pts[c, 1])) / det
+        beta = ((pts[c, 1] - pts[a, 1]) * (center[0] - pts[c, 0]) +
+                (pts[a, 0] - pts[c, 0]) * (center[1] - pts[c, 1])) / det
+        gamma = 1.0 - alpha - beta
+        if alpha >= 0 and beta >= 0 and gamma >= 0:
+            return k
+    return -1
+
+
+def facet_geometry(pts, simplices, central_point):
+    """normals pointing away from central_point (not normalized) and areas
+    of all simplices, vectorized versions of calculate_outside_normal and
+    area"""
+    pts = np.asarray(pts)
+    p0 = pts[simplices[:, 0]]
+    normals = np.cross(pts[simplices[:, 1]] - p0, pts[simplices[:, 2]] - p0)
+    to_center = np.asarray(central_point) - p0
+    cos = (np.einsum("ij,ij->i", to_center, normals) /
+           (np.linalg.norm(to_center, axis=1) *
+            np.linalg.norm(normals, axis=1)))
+    inside = np.arccos(np.clip(cos, -1.0, 1.0)) < 1.571
+    normals[inside] *= -1
+    areas = np.linalg.norm(normals, axis=1) / 2
+    return normals, areas
+
+
+def norm_and_area_lists(pts, simplices, central_point, threshold):
+    """same result as calc_norm_and_area_lists"""
+    normals, areas = facet_geometry(pts, simplices, central_point)
+    labels, firsts = group_facets(normals, threshold)
+    # summed in the order of the facets, like the python version
+    group_areas = np.bincount(labels, weights=areas, minlength=len(firsts))
+    return ([normals[i] for i in firsts], group_areas.tolist(),
+            FacetGroups.from_labels(labels, simplices, len(firsts)),
+            sum(areas.tolist()))
+
+
+def is_stable(pts, simplices, center):
+    return first_stable_simplex(pts, np.asarray(simplices),
+                                np.asarray(center, dtype=np.float64)) >= 0
+
+
+def random_hull(points, seed):
+    """convex hull of noisy points on an ellipsoid with some flat cuts"""
+    from scipy.spatial import ConvexHull
+    rng = np.random.RandomState(seed)
+    pts = rng.normal(size=(points, 3))
+    pts /= np.linalg.norm(pts, axis=1)[:, None]
+    pts *= [1., .6, .4]
+    # flat sides give planes with many facets
+    pts[:, 2] = np.clip(pts[:, 2], -.3, .3)
+    pts += rng.uniform(-1e-3, 1e-3, pts.shape)
+    return pts, ConvexHull(pts)
+
+
+def mesh_hull(path):
+    import calculate_physically_sound_orientations as orientations
+    from scipy.spatial import ConvexHull
+    mesh = orientations.load_mesh_and_move_to_origin(path)
+    pts = mesh.vertices.astype(np.float64)
+    return pts, ConvexHull(pts)
+
+
+def both_implementations(function, *args):
+    """results of function with the python implementation and with the
+    kernels (compiled if numba is installed)"""
+    # the orientation script reads the flag of the imported module, which
+    # is not this one when the file is run as a script
+    import orientation_kernels as kernels
+    enabled = kernels.ENABLED
+    try:
+        kernels.ENABLED = False
+        python_result = function(*args)
+        kernels.ENABLED = True
+        kernel_result = function(*args)
+    finally:
+        kernels.ENABLED = enabled
+    return python_result, kernel_result
+
+
+def check_parity(pts, hull):
+    """compare planes and stability of both implementations for one hull,
+    returns a list of the differences. The points can be float64 or
+    float32"""
+    import calculate_physically_sound_orientations as orientations
+    central_point = pts[hull.vertices].mean(axis=0)
+    python, kernel = both_implementations(
+        orientations.calc_norm_and_area_lists, pts, hull, central_point)
+    errors = []
+    if not (np.array_equal(python[2].offsets, kernel[2].offsets) and
+            np.array_equal(python[2].simplices, kernel[2].simplices)):
+        errors.append("different planes (%d python, %d kernel)" % (
+            len(python[2]), len(kernel[2])))
+        return errors
+    if not np.allclose(python[0], kernel[0], rtol=1e-12, atol=0):
+        errors.append("different plane normals")
+    if not np.allclose(python[1], kernel[1], rtol=AREA_RTOL[pts.dtype],
+                       atol=0):
+        errors.append("different plane areas")
+
+    # stability of every plane for the centroid and some shifted points
+    rng = np.random.RandomState(len(pts))
+    centers = np.vstack([central_point,
+                         central_point + rng.normal(scale=.2, size=(20, 3))])
+    for group in python[2]:
+        for center in centers:
+            stable = both_implementations(orientations.stability_check,
+                                          _Points(pts), center, group, 0)
+            if stable[0] != stable[1]:
+                errors.append("different stability for %s" % center)
+    return errors
+
+
+class _Points:
+    """the part of a mesh that stability_check uses"""
+
+    def __init__(self, vertices):
+        self.vertices = vertices
+
+
+def benchmark(pts, hull, repeats):
+    """best times of the python and kernel plane grouping and stability
+    check of all planes"""
+    import calculate_physically_sound_orientations as orientations
+    import orientation_kernels as kernels
+    central_point = pts[hull.vertices].mean(axis=0)
+    enabled = kernels.ENABLED
+    times = {}
+    try:
+        for name, flag in (("python", False), ("kernel", True)):
+            kernels.ENABLED = flag
+            # the first call compiles the kernels
+            planes = orientations.calc_norm_and_area_lists(pts, hull,
+                                                           central_point)
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                planes = orientations.calc_norm_and_area_lists(
+                    pts, hull, central_point)
+                for group in planes[2]:
+                    orientations.stability_check(_Points(pts),
+                                                 central_point, group, 0)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            times[name] = best
+    finally:
+        kernels.ENABLED = enabled
+    return times
+
+
+def main(argv):
+    usage = ("orientation_kernels.py [-n <hull points,...>] [-r <repeats>] "
+             "[mesh ...]")
+    try:
+        opts, args = getopt.gnu_getopt(argv, "hn:r:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    sizes = BENCHMARK_POINTS
+    repeats = REPEATS
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        elif opt == "-n":
+            sizes = [int(points) for points in arg.split(",")]
+        elif opt == "-r":
+            repeats = int(arg)
+
+    if not HAVE_NUMBA:
+        print("numba is not installed, the kernels run as python code")
+
+    hulls = [("random hull %d" % seed, random_hull(POINTS, seed))
+             for seed in PARITY_SEEDS]
+    hulls += [(path, mesh_hull(path)) for path in args]
+    failed = 0
+    for name, (pts, hull) in hulls:
+        for dtype in PARITY_DTYPES:
+            # facets standing vertically divide by zero in the stability
+            # check
+            with np.errstate(divide="ignore", invalid="ignore"):
+                errors = check_parity(pts.astype(dtype), hull)
+            print("%s (%d facets, %s): %s" % (
+                name, len(hull.simplices), np.dtype(dtype).name,
+                "; ".join(errors) or "identical"))
+            failed += bool(errors)
+
+    for points in sizes:
+        pts, hull = random_hull(points, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            times = benchmark(pts, hull, repeats)
+        print("%d facets: python %.3f s, kernel %.3f s, speedup %.1fx" % (
+            len(hull.simplices), times["python"], times["kernel"],
+            times["python"] / times["kernel"]))
+    if failed:
+        print("%d of %d checks differ" % (
+            failed, len(hulls) * len(PARITY_DTYPES)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,15 +2,39 @@
 # Blender might not release memory even if you delete an object,
 # so rendering a large number of object in one run may occupy a lot of memory.
 # If this happens, it is better to split the list into multiple runs..
+# render_farm.py does this automatically with several worker processes.
+# Meshes, materials and images without users are removed after every model
+# and the datablock counts and RSS are logged, see purge_orphans.
 import sys
+import getopt
+import json
+import time
+import traceback
 import bpy
 import os.path
 import math
+import numpy
+from mathutils import Matrix
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from image_shards import ShardReader, ShardWriter, SHARD_SIZE  # noqa: E402
+from image_writer import AsyncImageWriter, PNG_LEVEL  # noqa: E402
+from render_trace import Tracer  # noqa: E402
+from view_dedup import GroupDeduplicator  # noqa: E402
+import render_common  # noqa: E402
+from render_common import (  # noqa: E402
+    camera_location, orientation_path, rename_orientations, view_coords,
+    view_name
+)
 
 C = bpy.context
 D = bpy.data
 scene = D.scenes['Scene']
 
+# image pixels support foreach_get since Blender 2.83. Before, reading them
+# builds a python list of width * height * 4 floats for every view
+FAST_PIXELS = bpy.app.version >= (2, 83, 0)
+
 # cameras: a list of camera positions
 # a camera position is defined by two parameters: (theta, phi),
 # where we fix the "r" of (r, theta, phi) in spherical coordinate system.
@@ -20,7 +44,7 @@ cameras = [
     (60, 0), (60, 90), (60, 180), (60, 270),
     (0, 0)
 ]
-num_of_instances = 300
+num_of_instances = render_common.NUM_OF_INSTANCES
 # 12 orientations around the object with 30-deg elevation
 cameras = [(60, i) for i in range(0, 360, 30)]
 print(cameras)
@@ -35,6 +59,25 @@ h = 500
 render_setting.resolution_x = w
 render_setting.resolution_y = h
 
+# set in main when the images are written to shards instead of single files
+shard_writer = None
+# set in main to render all views of an orientation as one animation job
+batch_render = False
+# set in main to import every model once and apply the orientation poses
+single_import = False
+# set in main to skip views written by an earlier run
+resume = False
+# names of the images in existing shards, only used with resume
+sharded_views = set()
+# set in main to encode and write the images in background threads
+image_writer = None
+# stage timings, written to a file with --trace
+tracer = Tracer()
+# set in main to skip rotation steps that duplicate earlier views
+deduplicator = None
+
+MATERIAL_NAME = 'MaterialName'
+
 
 def install_off_addon():
     try:
@@ -60,7 +103,7 @@ def init_camera():
 
     # set the rendering mode to orthogonal and scale
     C.object.data.type = 'PERSP'
-    C.object.data.lens = 5.5
+    C.object.data.lens = render_common.CAMERA_LENS
 
 
 def fix_camera_to_origin():
@@ -88,7 +131,8 @@ def fix_camera_to_origin():
     cam.constraints['Track To'].up_axis = 'UP_Y'
 
 
-def render_model(model_name, save_dir_rotnet, input_dir):
+def render_model(model_name, save_dir_rotnet, input_dir,
+                 variable_angle=False):
     print("Input dir is: ", input_dir)
     rot_num, rot_step_size, full_path, num_orient = get_rot_num(model_name,
                                                                 input_dir)
@@ -96,141 +140,226 @@ def render_model(model_name, save_dir_rotnet, input_dir):
     counter = 0
     rot_num = math.ceil(rot_num)
 
-    count = 0
-    for filename in os.listdir(full_path):
-        print(filename)
-        if filename.startswith("orientation"):
-            os.rename(os.path.join(full_path, filename),
-                      os.path.join(full_path,
-                                   model_name + "_" + str(count) + ".obj"))
-            count = count + 1
+    done = done_views(image_subdir_rotnet) if resume else set()
+    total = 0
+    skipped = 0
+
+    sidecar = load_poses(full_path) if single_import else None
+    if sidecar is not None:
+        # import the mesh once and move it into every orientation
+        base_path, poses = sidecar
+        missing = []
+        for pose in poses:
+            views, cc1 = orientation_views(model_name, counter, rot_num,
+                                           rot_step_size, variable_angle)
+            missing.append([view for view in views if view[0] not in done])
+            counter += cc1
+            total += len(views)
+            skipped += len(views) - len(missing[-1])
+        report_resume(model_name, total, skipped)
+        if not any(missing):
+            return
+
+        with tracer.span('load'):
+            loaded_model = load_model(base_path)
+        obj = D.objects[loaded_model]
+        assign_material(obj)
+        with tracer.span('normalize', poses=len(poses)):
+            matrices = pose_matrices(obj, poses)
+        for matrix, views in zip(matrices, missing):
+            if views:
+                obj.matrix_world = matrix
+                render_orientation(image_subdir_rotnet, views)
+        delete_model(loaded_model)
+        return
+
+    rename_orientations(model_name, full_path)
 
     for k in range(0, num_orient):
-        full_file_path = os.path.join(full_path,
-                                      model_name + "_" + str(k) + ".obj")
+        full_file_path = orientation_path(full_path, model_name, k)
         print(full_file_path)
 
-        init_camera()
-        fix_camera_to_origin()
+        cc1 = 0
         if os.path.isfile(full_file_path):
-            cc1 = 0
-            loaded_model = load_model(full_file_path)
-            center_model(loaded_model)
-            normalize_model(loaded_model)
-            obj = D.objects[loaded_model]
-            obj.rotation_euler.x -= math.pi / 2
-            mat = bpy.data.materials.new('MaterialName')
-            mat.diffuse_color = (1.0, 1.0, 1.0)
-            mat.diffuse_shader = 'LAMBERT'
-            mat.diffuse_intensity = 1.0
-            # get the material
-            mat = bpy.data.materials['MaterialName']
-            # assign material to object
-            obj.data.materials.append(mat)
-
-            print(full_file_path)
-            for j in range(0, rot_num):
-                cc1 = cc1 + 1
-                rot = j * rot_step_size
-                # cameras = [(60, i + rot) for i in range(0, 360, 30)]
-                cc = 0
-
-                for i in range(0, 360, 30):
-                    cc = cc + 1
-                    c = (45, i + rot)
-                    move_camera(c)
-                    render()
-
-                    save(image_subdir_rotnet,
-                         '%s_%s_%s' % (model_name,
-                                       str(math.ceil(cc1+counter)).zfill(4),
-                                       str(cc).zfill(3)))
-
-            delete_model(loaded_model)
+            views, cc1 = orientation_views(model_name, counter, rot_num,
+                                           rot_step_size, variable_angle)
+            missing = [view for view in views if view[0] not in done]
+            total += len(views)
+            skipped += len(views) - len(missing)
+
+            if missing:
+                with tracer.span('load'):
+                    loaded_model = load_model(full_file_path)
+                with tracer.span('normalize'):
+                    center_model(loaded_model)
+                    normalize_model(loaded_model)
+                obj = D.objects[loaded_model]
+                obj.rotation_euler.x -= math.pi / 2
+                assign_material(obj)
+
+                print(full_file_path)
+                render_orientation(image_subdir_rotnet, missing)
+
+                delete_model(loaded_model)
 
         counter = counter + cc1
 
+    report_resume(model_name, total, skipped)
+
+
+def orientation_views(model_name, counter, rot_num, rot_step_size,
+                      variable_angle):
+    """(name, camera coord) of all views of all rotation steps of one
+    orientation, numbering the instances after counter. Returns the views
+    and the number of instances"""
+    cc1 = 0
+    views = []
+    for j in range(0, rot_num):
+        cc1 = cc1 + 1
+        rot = j * rot_step_size
+        # cameras = [(60, i + rot) for i in range(0, 360, 30)]
+
+        for cc, c in enumerate(view_coords(rot, variable_angle), 1):
+            views.append((view_name(model_name, cc1 + counter, cc), c))
+    return views, cc1
+
+
+def render_orientation(image_dir, views):
+    """Render the views of the loaded orientation. With --dedup-threshold,
+    the views are rendered group by group (one rotation step) and the
+    remaining rotation steps are skipped as soon as a group duplicates an
+    earlier group of the model"""
+    if deduplicator is None:
+        render_views(image_dir, views)
+        return
+
+    groups = [views[i:i + render_common.NUM_VIEWS]
+              for i in range(0, len(views), render_common.NUM_VIEWS)]
+    for number, group in enumerate(groups, 1):
+        render_views(image_dir, group)
+        if deduplicator.end_group():
+            print('Duplicate views, skipping %d of %d rotation steps' % (
+                len(groups) - number, len(groups)))
+            return
+
+
+def render_views(image_dir, views):
+    """render the (name, camera coord) views of the loaded orientation"""
+    if batch_render:
+        render_batch(image_dir, views)
+    else:
+        for name, c in views:
+            move_camera(c)
+            with tracer.span('render'):
+                render()
+            if deduplicator is not None:
+                with tracer.span('hash'):
+                    deduplicator.add_view(grab_pixels())
+
+            with tracer.span('save'):
+                save(image_dir, name)
+    tracer.count_views(len(views))
+
+
+def done_views(image_dir):
+    """names of the views of a model that were completely written by an
+    earlier run"""
+    if shard_writer is not None:
+        prefix = os.path.basename(image_dir) + '/'
+        return set(os.path.splitext(name[len(prefix):])[0]
+                   for name in sharded_views if name.startswith(prefix))
+    return render_common.rendered_views(image_dir)
+
+
+def report_resume(model_name, total, skipped):
+    if resume:
+        print('%s: %d of %d views already rendered' % (model_name, skipped,
+                                                       total))
+
+
+def shared_material():
+    """the white Lambert material of all models, created once per run"""
+    mat = D.materials.get(MATERIAL_NAME)
+    if mat is None:
+        mat = D.materials.new(MATERIAL_NAME)
+        mat.diffuse_color = (1.0, 1.0, 1.0)
+        mat.diffuse_shader = 'LAMBERT'
+        mat.diffuse_intensity = 1.0
+        # keep it when the last model using it is deleted
+        mat.use_fake_user = True
+    return mat
+
+
+def assign_material(obj):
+    mat = shared_material()
+    if mat.name not in obj.data.materials:
+        obj.data.materials.append(mat)
+
+
+def purge_orphans():
+    """Remove meshes, materials and images without users. Deleting an
+    object leaves its datablocks in bpy.data, which otherwise grows for
+    the whole run. Returns the number of removed datablocks"""
+    removed = 0
+    for collection in (D.meshes, D.materials, D.images):
+        for block in list(collection):
+            if block.users > 0:
+                continue
+            # the render result and the viewer node image of init_viewer
+            if getattr(block, 'type', None) in ('RENDER_RESULT',
+                                                'COMPOSITING'):
+                continue
+            collection.remove(block)
+            removed += 1
+    return removed
+
+
+def datablock_counts():
+    return {'objects': len(D.objects), 'meshes': len(D.meshes),
+            'materials': len(D.materials), 'images': len(D.images)}
+
+
+def load_poses(full_path):
+    """Base mesh and orientation matrices written next to the orientation
+    folder by the orientation scripts, None if there is no such file"""
+    path = full_path + '_poses.json'
+    if not os.path.isfile(path):
+        print('No poses found at ' + path + ', importing every orientation')
+        return None
+    with open(path) as f:
+        sidecar = json.load(f)
+    names = sorted(sidecar['poses'],
+                   key=lambda name: int(name.rsplit('_', 1)[1]))
+    base_path = os.path.join(os.path.dirname(full_path), sidecar['base'])
+    return base_path, [sidecar['poses'][name] for name in names]
+
+
+def pose_matrices(obj, poses):
+    """World matrices that put the imported base mesh into every pose,
+    centered and scaled to unit size like center_model and normalize_model
+    do for the exported orientations."""
+    count = len(obj.data.vertices)
+    co = numpy.empty(count * 3, dtype=numpy.float32)
+    obj.data.vertices.foreach_get('co', co)
+
+    # undo the axis conversion of the importer, the poses are given in the
+    # coordinates of the OBJ file. render_model rotates the exported
+    # orientations back the same way.
+    to_file = numpy.dot(numpy.array(Matrix.Rotation(-math.pi / 2, 4, 'X')),
+                        numpy.array(obj.matrix_world))
+
+    poses = [numpy.dot(numpy.array(pose), to_file) for pose in poses]
+    return [Matrix(matrix.tolist()) for matrix in
+            render_common.normalized_poses(co.reshape(-1, 3), poses)]
 
-def render_model_variable_angle(model_name, save_dir_rotnet, input_dir):
-    print("Input dir is: ", input_dir)
-    rot_num, rot_step_size, full_path, num_orient = get_rot_num(model_name,
-                                                                input_dir)
-    image_subdir_rotnet = os.path.join(save_dir_rotnet, model_name)
-    counter = 0
-    rot_num = math.ceil(rot_num)
 
-    count = 0
-    for filename in os.listdir(full_path):
-        print(filename)
-        if filename.startswith("orientation"):
-            os.rename(os.path.join(full_path, filename),
-                      os.path.join(full_path,
-                                   model_name + "_" + str(count) + ".obj"))
-            count = count + 1
-
-    for k in range(0, num_orient):
-        full_file_path = os.path.join(full_path,
-                                      model_name + "_" + str(k) + ".obj")
-        print(full_file_path)
-
-        init_camera()
-        fix_camera_to_origin()
-        if os.path.isfile(full_file_path):
-            cc1 = 0
-            loaded_model = load_model(full_file_path)
-            center_model(loaded_model)
-            normalize_model(loaded_model)
-            obj = D.objects[loaded_model]
-            obj.rotation_euler.x -= math.pi / 2
-            mat = bpy.data.materials.new('MaterialName')
-            mat.diffuse_color = (1.0, 1.0, 1.0)
-            mat.diffuse_shader = 'LAMBERT'
-            mat.diffuse_intensity = 1.0
-            # get the material
-            mat = bpy.data.materials['MaterialName']
-            # assign material to object
-            obj.data.materials.append(mat)
-
-            print(full_file_path)
-            for j in range(0, rot_num):
-                cc1 = cc1 + 1
-                rot = j * rot_step_size
-                # cameras = [(60, i + rot) for i in range(0, 360, 30)]
-                cc = 0
-
-                for i in range(0, 360, 30):
-                    cc = cc + 1
-                    vert_angle = 45
-                    if (i % 60 == 0):
-                        vert_angle = 35
-                    else:
-                        vert_angle = 55
-
-                    c = (vert_angle, i + rot)
-                    move_camera(c)
-                    render()
-
-                    save(image_subdir_rotnet,
-                         '%s_%s_%s' % (model_name,
-                                       str(math.ceil(cc1+counter)).zfill(4),
-                                       str(cc).zfill(3)))
-
-            delete_model(loaded_model)
-
-        counter = counter + cc1
+def render_model_variable_angle(model_name, save_dir_rotnet, input_dir):
+    """views alternate between 35 and 55 degrees elevation"""
+    render_model(model_name, save_dir_rotnet, input_dir, variable_angle=True)
 
 
 def get_rot_num(path, input_dir):
-    DIR = os.path.dirname(__file__) + '/' + input_dir
-    print("DIR is: ",  path)
-    name1 = os.path.basename(path).split('.')[0]
-    path = os.path.join(DIR, name1)
-    print("path is: ",  path)
-    print(sum([len(files) for r, d, files in os.walk(path)]))
-    num_orientation = sum([len(files) for r, d, files in os.walk(path)])
-    rot_num = num_of_instances / num_orientation
-    rot_step_size = 30 / rot_num
-    return rot_num, rot_step_size, path, num_orientation
+    return render_common.get_rot_num(path, input_dir, num_of_instances)
 
 
 def load_model(path):
@@ -290,40 +419,238 @@ def normalize_model(name):
 
 
 def move_camera(coord):
-    def deg2rad(deg):
-        return deg * math.pi / 180.
-
-    r = 2.
-    theta, phi = deg2rad(coord[0]), deg2rad(coord[1])
-    loc_x = r * math.sin(theta) * math.cos(phi)
-    loc_y = r * math.sin(theta) * math.sin(phi)
-    loc_z = r * math.cos(theta)
-
-    D.objects['Camera'].location = (loc_x, loc_y, loc_z)
+    D.objects['Camera'].location = camera_location(coord)
 
 
 def render():
     bpy.ops.render.render()
 
 
+def render_batch(image_dir, views):
+    """Render all (name, camera coord) views of the loaded orientation in
+    one animation job. Every view is a keyframe of the camera location, so
+    the scene is synced once instead of once per view. The frames are
+    rendered to a temporary folder and then moved to their names."""
+    cam = D.objects['Camera']
+    for frame, (name, c) in enumerate(views, 1):
+        cam.location = camera_location(c)
+        cam.keyframe_insert(data_path='location', frame=frame)
+
+    if shard_writer is not None:
+        tmp_dir = shard_writer.root
+    else:
+        tmp_dir = os.path.dirname(image_dir)
+    tmp_dir = os.path.join(tmp_dir, '.batch_%d' % os.getpid())
+
+    scene.frame_start = 1
+    scene.frame_end = len(views)
+    render_setting.filepath = os.path.join(tmp_dir, '#####')
+    render_setting.use_file_extension = True
+    render_setting.image_settings.file_format = 'PNG'
+    with tracer.span('render', views=len(views)):
+        bpy.ops.render.render(animation=True)
+    cam.animation_data_clear()
+
+    with tracer.span('save', views=len(views)):
+        for frame, (name, c) in enumerate(views, 1):
+            store(image_dir, name, os.path.join(tmp_dir, '%05d.png' % frame))
+    os.rmdir(tmp_dir)
+
+
+def store(image_dir, name, path):
+    """move a rendered image file to its final place"""
+    if shard_writer is not None:
+        shard_name = os.path.basename(image_dir) + '/' + name + '.png'
+        shard_writer.write_file(shard_name, path)
+        os.remove(path)
+        print('save to shard ' + shard_name)
+        return
+
+    target = os.path.join(image_dir, name + '.png')
+    os.makedirs(image_dir, exist_ok=True)
+    os.replace(path, target)
+    print('save to ' + target)
+
+
+def init_viewer():
+    """Also send the composited image to a Viewer Node. Unlike the Render
+    Result, its pixels can be read from python"""
+    scene.use_nodes = True
+    tree = scene.node_tree
+    nodes = {node.type: node for node in tree.nodes}
+    layers = nodes.get('R_LAYERS') or tree.nodes.new('CompositorNodeRLayers')
+    composite = nodes.get('COMPOSITE')
+    if composite is None:
+        composite = tree.nodes.new('CompositorNodeComposite')
+        tree.links.new(layers.outputs['Image'], composite.inputs['Image'])
+    viewer = nodes.get('VIEWER') or tree.nodes.new('CompositorNodeViewer')
+    viewer.use_alpha = True
+    # show what is composited, not only the render layer
+    source = layers.outputs['Image']
+    if composite.inputs['Image'].links:
+        source = composite.inputs['Image'].links[0].from_socket
+    tree.links.new(source, viewer.inputs['Image'])
+
+
+def grab_pixels():
+    """copy of the float RGBA pixels of the last render"""
+    image = D.images['Viewer Node']
+    width, height = image.size
+    pixels = numpy.empty(width * height * 4, dtype=numpy.float32)
+    try:
+        image.pixels.foreach_get(pixels)
+    except (AttributeError, TypeError):
+        # slow path before Blender 2.83, see FAST_PIXELS
+        pixels[:] = image.pixels[:]
+    return pixels.reshape(height, width, 4)
+
+
+def image_channels():
+    """number of channels of the configured output color mode"""
+    return {'BW': 1, 'RGB': 3}.get(
+        render_setting.image_settings.color_mode, 4)
+
+
 def save(image_dir, name):
+    if image_writer is not None:
+        image_writer.submit(image_dir, name, grab_pixels())
+        return
+
+    if shard_writer is not None:
+        # blender can only save the render result to a file,
+        # so it is written to a temporary file and moved into the shard
+        shard_name = os.path.basename(image_dir) + '/' + name + '.png'
+        path = os.path.join(shard_writer.root,
+                            '.tmp_%s_%d.png' % (shard_writer.prefix,
+                                                os.getpid()))
+        D.images['Render Result'].save_render(filepath=path)
+        store(image_dir, name, path)
+        return
+
     path = os.path.join(image_dir, name + '.png')
     D.images['Render Result'].save_render(filepath=path)
     print('save to ' + path)
 
 
 def main():
+    global shard_writer, batch_render, single_import, resume, sharded_views
+    global image_writer, tracer, deduplicator
+
     argv = sys.argv
     argv = argv[argv.index('--') + 1:]
+    usage = ('phong.py args: <3d mesh list file> <save dir rotnet> '
+             '[--shards] [--shard-size <images per shard>] [--batch] '
+             '[--input-dir <dir>] [--progress <file>] [--max-rss <MB>] '
+             '[--single-import] [--resume] [--async-write] '
+             '[--png-level <0-9>] [--raw] [--write-workers <number>] '
+             '[--write-queue <images>] [--trace <file>] '
+             '[--dedup-threshold <bits>]\n'
+             '--async-write needs Blender 2.83 or newer for PNGs, with '
+             'older versions (phong.blend is a 2.79 file) the PNGs are '
+             'saved with save_render')
+
+    try:
+        opts, argv = getopt.gnu_getopt(argv, '', ['shards', 'shard-size=',
+                                                  'batch', 'input-dir=',
+                                                  'progress=', 'max-rss=',
+                                                  'single-import', 'resume',
+                                                  'async-write', 'png-level=',
+                                                  'raw', 'write-workers=',
+                                                  'write-queue=', 'trace=',
+                                                  'dedup-threshold='])
+    except getopt.GetoptError:
+        print(usage)
+        exit(-1)
 
-    if len(argv) != 3:
-        print('phong.py args: <3d mesh list file> <save dir rotnet>')
+    # a third argument used to be required, it is still accepted
+    if len(argv) not in (2, 3):
+        print(usage)
         exit(-1)
 
     models_list = argv[0]
     input_dir = models_list.split('\\')[0]
     save_dir_rotnet = argv[1]
 
+    use_shards = False
+    shard_size = SHARD_SIZE
+    progress_path = None
+    max_rss = None
+    async_write = False
+    png_level = None
+    image_format = 'png'
+    write_options = {}
+    for opt, arg in opts:
+        if opt == '--shards':
+            use_shards = True
+        elif opt == '--shard-size':
+            shard_size = int(arg)
+        elif opt == '--batch':
+            batch_render = True
+        elif opt == '--input-dir':
+            input_dir = arg
+        elif opt == '--progress':
+            # used by render_farm.py to follow the worker
+            progress_path = arg
+        elif opt == '--max-rss':
+            max_rss = float(arg)
+        elif opt == '--single-import':
+            single_import = True
+        elif opt == '--resume':
+            resume = True
+        elif opt == '--async-write':
+            async_write = True
+        elif opt == '--png-level':
+            png_level = int(arg)
+            if not 0 <= png_level <= 9:
+                print(usage)
+                exit(-1)
+        elif opt == '--raw':
+            # uncompressed NumPy arrays instead of PNG files
+            image_format = 'npy'
+        elif opt == '--write-workers':
+            write_options['workers'] = int(arg)
+        elif opt == '--write-queue':
+            write_options['queue_size'] = int(arg)
+        elif opt == '--trace':
+            tracer = Tracer(arg)
+        elif opt == '--dedup-threshold':
+            deduplicator = GroupDeduplicator(float(arg))
+    if use_shards:
+        if resume and os.path.isdir(save_dir_rotnet):
+            with ShardReader(save_dir_rotnet) as reader:
+                sharded_views = set(reader.names())
+        shard_writer = ShardWriter(save_dir_rotnet, shard_size)
+
+    if image_format == 'npy' and not async_write:
+        print('--raw needs --async-write')
+        exit(-1)
+    if async_write and image_format == 'png' and not FAST_PIXELS:
+        # copying the pixels through a python list on the render thread
+        # costs more than the save_render call the writer would replace
+        print('--async-write needs Blender 2.83 or newer, this is %s. PNGs '
+              'are saved with save_render' % bpy.app.version_string)
+        async_write = False
+    if deduplicator is not None:
+        if batch_render or resume:
+            # the views of a group must be rendered one by one and the
+            # skipped rotation steps would be rendered again on resume
+            print('--dedup-threshold can not be combined with --batch or '
+                  '--resume')
+            exit(-1)
+        init_viewer()
+    if async_write:
+        if batch_render:
+            print('--async-write can not be combined with --batch')
+            exit(-1)
+        init_viewer()
+        image_writer = AsyncImageWriter(
+            image_format, PNG_LEVEL if png_level is None else png_level,
+            image_channels(), shard_writer, **write_options)
+    elif png_level is not None:
+        # compression of save_render in percent
+        render_setting.image_settings.compression = int(
+            round(png_level * 100 / 9.))
+
     # blender has no native support for off files
     # install_off_addon()
 
@@ -333,8 +660,50 @@ def main():
     with open(models_list) as f:
         models = f.read().splitlines()
 
+    exit_code = 0
     for model in models:
-        render_model(model, save_dir_rotnet, input_dir)
+        start = time.time()
+        status = 'done'
+        tracer.begin_model(model)
+        if deduplicator is not None:
+            deduplicator.reset()
+        try:
+            render_model(model, save_dir_rotnet, input_dir)
+        except Exception:
+            traceback.print_exc()
+            status = 'failed'
+        removed = purge_orphans()
+        counts = datablock_counts()
+        rss = render_common.rss_mb()
+        record = tracer.end_model(status, time.time() - start, rss,
+                                  datablocks=counts)
+        print('%.2f views/s' % record['views_per_second'])
+        print('%s %s, removed %d datablocks, %s, RSS %.0f MB' % (
+            model, status, removed,
+            ', '.join('%d %s' % (counts[k], k) for k in sorted(counts)), rss))
+        if progress_path is not None:
+            with open(progress_path, 'a') as f:
+                f.write(json.dumps({'model': model, 'status': status,
+                                    'seconds': time.time() - start,
+                                    'rss_mb': rss,
+                                    'datablocks': counts}) + '\n')
+        if max_rss is not None and rss > max_rss:
+            # blender does not give the memory back, so the worker stops
+            # and the remaining models are rendered by a fresh process
+            print('RSS %.0f MB above %.0f MB, stopping' % (rss, max_rss))
+            exit_code = render_common.RECYCLE_EXIT_CODE
+            break
+
+    if image_writer is not None:
+        # wait for the images still in the queue
+        with tracer.span('save_queue'):
+            image_writer.close()
+    if shard_writer is not None:
+        shard_writer.close()
+    tracer.close()
+
+    if exit_code != 0:
+        sys.exit(exit_code)
 
 
 if __name__ == '__main__':
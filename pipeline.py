@@ -0,0 +1,328 @@
+"""End-to-end pipeline from meshes to training lists.
+
+Runs the stages
+
+    orient   calculate_physically_sound_orientations.py (or random)
+    render   phong_multi_for_rotnet.py in blender (or numpy_renderer.py)
+    augment  image_augmentation.py
+    lists    rotnet_list_creation.py
+
+for every mesh (OBJ, STL, ...) of a folder. Every stage has its own
+bounded pool of workers and a model is handed to the next stage as soon as
+it is done, so the stages run at the same time and the run takes about as
+long as its slowest stage instead of the sum of all of them. The lists are
+written once all models are through. The state and time of every model and
+stage is kept in run_manifest.json in the output folder:
+
+python pipeline.py <mesh dir> <output dir> --render-workers 2 --seed 1 \
+    --split 0.8,0.2 -- --single-import
+
+Arguments after "--" are passed on to phong_multi_for_rotnet.py. The
+output folder contains renders/, augmented/ and lists/.
+"""
+import sys
+import getopt
+import json
+import os
+import random
+import subprocess
+import time
+import traceback
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+from render_farm import BLEND_FILE, BLENDER, RENDER_SCRIPT
+
+ORIENT_WORKERS = os.cpu_count() or 1
+RENDER_WORKERS = 2
+AUGMENT_WORKERS = os.cpu_count() or 1
+RENDERERS = ("blender", "numpy")
+MANIFEST_NAME = "run_manifest.json"
+LIST_NAME = "list.txt"
+
+# augmentation pipeline of an augment worker process
+_augmentation = None
+
+
+def find_models(mesh_dir):
+    """model name -> mesh file of the meshes in mesh_dir"""
+    import compact_mesh
+    return compact_mesh.find_meshes(mesh_dir)
+
+
+def orient_model(mesh_dir, mesh_file, random_orientations=False):
+    if random_orientations:
+        import calculate_random_orientations as orientations
+    else:
+        import calculate_physically_sound_orientations as orientations
+    orientations.create_training_orientations(
+        os.path.join(mesh_dir, mesh_file))
+
+
+def render_model_numpy(mesh_dir, render_dir, model):
+    import numpy_renderer
+    numpy_renderer.render_model(model, render_dir, mesh_dir)
+
+
+def render_model_blender(mesh_dir, render_dir, model, work_dir,
+                         blender=BLENDER, extra_args=()):
+    """render one model in a headless blender process"""
+    list_path = os.path.join(work_dir, model + ".txt")
+    progress_path = os.path.join(work_dir, model + ".progress")
+    log_path = os.path.join(work_dir, model + ".log")
+    with open(list_path, "w") as f:
+        f.write(model + "\n")
+    if os.path.isfile(progress_path):
+        os.remove(progress_path)
+
+    command = [blender, "-b", BLEND_FILE, "-P", RENDER_SCRIPT, "--",
+               list_path, render_dir, "--input-dir", mesh_dir,
+               "--progress", progress_path] + list(extra_args)
+    with open(log_path, "w") as log:
+        code = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+
+    # the render script catches the errors of a model and goes on
+    status = None
+    if os.path.isfile(progress_path):
+        with open(progress_path) as f:
+            for line in f:
+                if line.strip():
+                    status = json.loads(line)["status"]
+    if code != 0 or status != "done":
+        raise RuntimeError("Rendering %s failed (exit code %d), see %s" % (
+            model, code, log_path))
+
+
+def augment_model(render_dir, augment_dir, model, seed=None):
+    global _augmentation
+    import image_augmentation
+    if _augmentation is None:
+        _augmentation = image_augmentation.build_pipeline()
+    os.makedirs(os.path.join(augment_dir, model), exist_ok=True)
+    image_augmentation.augment_folder(render_dir + "/", augment_dir + "/",
+                                      model, _augmentation, seed=seed)
+
+
+def write_lists(image_dir, models, list_path, seed=None, ratios=None,
+                num_shards=1):
+    """training lists of all instances of the models with all views"""
+    import rotnet_list_creation as lists
+    rng = random.Random(seed)
+    base_path, data_set_name = os.path.split(os.path.abspath(image_dir))
+    prefixes = lists.class_prefixes(models, base_path, data_set_name)
+    index = lists.build_render_index(image_dir)
+    lists.report_holes(lists.find_holes(index, models))
+    if ratios is not None or num_shards > 1:
+        return lists.write_split_lists(
+            list_path, prefixes, lists.complete_instances(index, models),
+            ratios or [1.], num_shards, rng)
+    return {list_path: lists.write_list_from_index(list_path, models,
+                                                   prefixes, index, rng)}
+
+
+class RunManifest:
+    """state and duration of every model in every stage"""
+
+    def __init__(self, path, config):
+        self.path = path
+        self.start = time.time()
+        self.data = {"config": config, "started": time.ctime(self.start),
+                     "models": {}, "lists": None}
+
+    def update(self, model, stage, status, seconds=None, error=None):
+        record = {"status": status}
+        if seconds is not None:
+            record["seconds"] = seconds
+        if error is not None:
+            record["error"] = error
+        self.data["models"].setdefault(model, {})[stage] = record
+        self.save()
+
+    def save(self):
+        self.data["wall_seconds"] = time.time() - self.start
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def timed(function, *args):
+    """run function and return its duration, used in the stage workers"""
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def run_pipeline(mesh_dir, output_dir, models=None, renderer="blender",
+                 random_orientations=False, augment=True, seed=None,
+                 ratios=None, num_shards=1, orient_workers=ORIENT_WORKERS,
+                 render_workers=RENDER_WORKERS,
+                 augment_workers=AUGMENT_WORKERS, blender=BLENDER,
+                 extra_args=()):
+    """run all stages, streaming every model to the next stage as soon as
+    it is ready. Returns the run manifest"""
+    mesh_dir = os.path.abspath(mesh_dir)
+    render_dir = os.path.join(output_dir, "renders")
+    augment_dir = os.path.join(output_dir, "augmented")
+    list_dir = os.path.join(output_dir, "lists")
+    work_dir = os.path.join(output_dir, ".pipeline")
+    for path in (render_dir, augment_dir, list_dir, work_dir):
+        os.makedirs(path, exist_ok=True)
+    meshes = find_models(mesh_dir)
+    if models is None:
+        models = list(meshes)
+
+    manifest = RunManifest(os.path.join(output_dir, MANIFEST_NAME), {
+        "mesh_dir": mesh_dir, "renderer": renderer,
+        "random_orientations": random_orientations, "augment": augment,
+        "seed": seed, "split": ratios, "shards": num_shards,
+        "render_args": list(extra_args)})
+
+    orient_pool = ProcessPoolExecutor(orient_workers)
+    if renderer == "blender":
+        # the work is done by the blender processes
+        render_pool = ThreadPoolExecutor(render_workers)
+    else:
+        render_pool = ProcessPoolExecutor(render_workers)
+    augment_pool = ProcessPoolExecutor(augment_workers)
+
+    def submit(stage, model):
+        if stage == "orient":
+            future = orient_pool.submit(timed, orient_model, mesh_dir,
+                                        meshes.get(model, model + ".obj"),
+                                        random_orientations)
+        elif stage == "render" and renderer == "blender":
+            future = render_pool.submit(timed, render_model_blender,
+                                        mesh_dir, render_dir, model,
+                                        work_dir, blender, extra_args)
+        elif stage == "render":
+            future = render_pool.submit(timed, render_model_numpy, mesh_dir,
+                                        render_dir, model)
+        else:
+            future = augment_pool.submit(timed, augment_model, render_dir,
+                                         augment_dir, model, seed)
+        manifest.update(model, stage, "running")
+        running[future] = (stage, model)
+
+    stages = ["orient", "render"] + (["augment"] if augment else [])
+    running = {}
+    finished = []
+    for model in models:
+        submit("orient", model)
+
+    try:
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, model = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as error:
+                    traceback.print_exception(type(error), error,
+                                              error.__traceback__)
+                    manifest.update(model, stage, "failed",
+                                    error=str(error))
+                    print("%s failed in %s" % (model, stage))
+                    continue
+                manifest.update(model, stage, "done", seconds)
+                print("%s done in %s after %.1f s" % (model, stage, seconds))
+                if stage == stages[-1]:
+                    finished.append(model)
+                else:
+                    submit(stages[stages.index(stage) + 1], model)
+    finally:
+        for pool in (orient_pool, render_pool, augment_pool):
+            pool.shutdown(wait=True)
+
+    # the lists need all models and keep the order of the models
+    finished = [model for model in models if model in finished]
+    start = time.time()
+    written = write_lists(augment_dir if augment else render_dir, finished,
+                          os.path.join(list_dir, LIST_NAME), seed, ratios,
+                          num_shards)
+    manifest.data["lists"] = {"status": "done", "models": len(finished),
+                              "seconds": time.time() - start,
+                              "files": written}
+    manifest.data["stage_seconds"] = {
+        stage: sum(record[stage].get("seconds", 0.)
+                   for record in manifest.data["models"].values()
+                   if stage in record)
+        for stage in stages}
+    manifest.save()
+    return manifest.data
+
+
+def main(argv):
+    usage = ("pipeline.py <mesh dir> <output dir> "
+             "[--renderer <blender|numpy>] [--random-orientations] "
+             "[--no-augment] [--seed <seed>] "
+             "[--split <train,val[,test] ratios>] [--shards <number>] "
+             "[--orient-workers <number>] [--render-workers <number>] "
+             "[--augment-workers <number>] [--blender <executable>] "
+             "[-- <arguments of phong_multi_for_rotnet.py>]")
+    extra_args = []
+    if "--" in argv:
+        extra_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    try:
+        opts, args = getopt.gnu_getopt(argv, "h", [
+            "renderer=", "random-orientations", "no-augment", "seed=",
+            "split=", "shards=", "orient-workers=", "render-workers=",
+            "augment-workers=", "blender="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    if len(args) != 2:
+        print(usage)
+        sys.exit(2)
+
+    mesh_dir, output_dir = args
+    options = {}
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        elif opt == "--renderer":
+            if arg not in RENDERERS:
+                print(usage)
+                sys.exit(2)
+            options["renderer"] = arg
+        elif opt == "--random-orientations":
+            options["random_orientations"] = True
+        elif opt == "--no-augment":
+            options["augment"] = False
+        elif opt == "--seed":
+            options["seed"] = int(arg)
+        elif opt == "--split":
+            options["ratios"] = [float(ratio) for ratio in arg.split(",")]
+        elif opt == "--shards":
+            options["num_shards"] = int(arg)
+        elif opt == "--orient-workers":
+            options["orient_workers"] = int(arg)
+        elif opt == "--render-workers":
+            options["render_workers"] = int(arg)
+        elif opt == "--augment-workers":
+            options["augment_workers"] = int(arg)
+        elif opt == "--blender":
+            options["blender"] = arg
+    import rotnet_list_creation as lists
+    if not lists.valid_split(options.get("ratios"),
+                             options.get("num_shards", 1)):
+        print(usage)
+        sys.exit(2)
+
+    result = run_pipeline(mesh_dir, output_dir, extra_args=extra_args,
+                          **options)
+    failed = sorted(model for model, stages in result["models"].items()
+                    if any(record["status"] != "done"
+                           for record in stages.values()))
+    print("%d models in %.0f s, stage times %s" % (
+        len(result["models"]), result["wall_seconds"],
+        ", ".join("%s %.0f s" % item
+                  for item in sorted(result["stage_seconds"].items()))))
+    if failed:
+        print("Failed models: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
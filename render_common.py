@@ -0,0 +1,187 @@
+"""Camera model, orientation bookkeeping and file naming shared by the
+Blender renderer (phong_multi_for_rotnet.py) and the NumPy renderer
+(numpy_renderer.py).
+
+Blender ships its own Python (3.5 for Blender 2.79), so this module only
+uses the standard library and no newer syntax.
+"""
+import math
+import os
+import re
+import sys
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+NUM_OF_INSTANCES = 300
+
+# camera on a sphere around the origin, looking at the origin
+CAMERA_DISTANCE = 2.
+CAMERA_LENS = 5.5  # mm, 'PERSP' camera
+SENSOR_WIDTH = 32.  # mm, blender default sensor width
+
+# 12 views around the object
+VIEW_STEP = 30
+NUM_VIEWS = 360 // VIEW_STEP
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+NPY_MAGIC = b'\x93NUMPY'
+
+# exit code of a render worker that stopped early to release its memory
+RECYCLE_EXIT_CODE = 3
+
+
+def deg2rad(deg):
+    return deg * math.pi / 180.
+
+
+def camera_location(coord):
+    """camera location for (theta, phi) in degrees"""
+    r = CAMERA_DISTANCE
+    theta, phi = deg2rad(coord[0]), deg2rad(coord[1])
+    loc_x = r * math.sin(theta) * math.cos(phi)
+    loc_y = r * math.sin(theta) * math.sin(phi)
+    loc_z = r * math.cos(theta)
+    return (loc_x, loc_y, loc_z)
+
+
+def view_coords(rot, variable_angle=False):
+    """(theta, phi) of the 12 views of one rotation step"""
+    coords = []
+    for i in range(0, 360, VIEW_STEP):
+        vert_angle = 45
+        if variable_angle:
+            if (i % 60 == 0):
+                vert_angle = 35
+            else:
+                vert_angle = 55
+        coords.append((vert_angle, i + rot))
+    return coords
+
+
+def view_name(model_name, instance, view):
+    """file name (without extension) of a view, e.g. model_0001_001"""
+    return '%s_%s_%s' % (model_name, str(math.ceil(instance)).zfill(4),
+                         str(view).zfill(3))
+
+
+def get_rot_num(path, input_dir, num_of_instances=NUM_OF_INSTANCES):
+    DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), input_dir)
+    print("DIR is: ",  path)
+    name1 = os.path.basename(path).split('.')[0]
+    path = os.path.join(DIR, name1)
+    print("path is: ",  path)
+    print(sum([len(files) for r, d, files in os.walk(path)]))
+    num_orientation = sum([len(files) for r, d, files in os.walk(path)])
+    rot_num = num_of_instances / num_orientation
+    rot_step_size = 30 / rot_num
+    return rot_num, rot_step_size, path, num_orientation
+
+
+def rename_orientations(model_name, full_path):
+    """Rename orientation_<n>.obj to <model_name>_<k>.obj in the order of n,
+    where k is the lowest free number. Files renamed by an earlier,
+    interrupted run keep their names, so the renaming can be repeated
+    safely and the numbers stay contiguous"""
+    pattern = re.compile(r'^orientation_(\d+)\.obj$')
+    pending = []
+    for filename in os.listdir(full_path):
+        print(filename)
+        match = pattern.match(filename)
+        if match:
+            pending.append((int(match.group(1)), filename))
+
+    count = 0
+    for number, filename in sorted(pending):
+        while os.path.exists(orientation_path(full_path, model_name, count)):
+            count += 1
+        os.rename(os.path.join(full_path, filename),
+                  orientation_path(full_path, model_name, count))
+
+
+def orientation_path(full_path, model_name, k):
+    return os.path.join(full_path, model_name + "_" + str(k) + ".obj")
+
+
+def normalized_poses(vertices, poses):
+    """Every pose (4x4) followed by the centering and scaling to unit size
+    that center_model and normalize_model apply to the exported
+    orientations, for the n x 3 vertices of the base mesh"""
+    # numpy is only needed here, the render farm does not import it
+    import numpy
+    co = numpy.c_[numpy.asarray(vertices, dtype=numpy.float64),
+                  numpy.ones(len(vertices))]
+    matrices = []
+    for pose in poses:
+        pose = numpy.asarray(pose, dtype=numpy.float64)
+        posed = numpy.dot(co, pose.T)[:, :3]
+        lo, hi = posed.min(axis=0), posed.max(axis=0)
+        size = (hi - lo).max()
+        scale = 1. / size if size > 0 else 1.
+        normalize = numpy.identity(4)
+        normalize[:3, :3] *= scale
+        normalize[:3, 3] = -scale * (lo + hi) / 2.
+        matrices.append(numpy.dot(normalize, pose))
+    return matrices
+
+
+def is_valid_png(path):
+    """True if the file starts with the PNG signature and ends with the
+    IEND chunk, i.e. it was written completely"""
+    try:
+        size = os.path.getsize(path)
+        if size < len(PNG_SIGNATURE) + len(PNG_END):
+            return False
+        with open(path, 'rb') as f:
+            if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return False
+            f.seek(size - len(PNG_END))
+            return f.read() == PNG_END
+    except (IOError, OSError):
+        return False
+
+
+def is_valid_npy(path):
+    """True if the file starts like a NumPy array file. They are only
+    written under their final name when complete"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def rendered_views(image_dir):
+    """names (without extension) of the completely written views (.png
+    or .npy) in image_dir"""
+    if not os.path.isdir(image_dir):
+        return set()
+    views = set()
+    for filename in os.listdir(image_dir):
+        path = os.path.join(image_dir, filename)
+        if ((filename.endswith('.png') and is_valid_png(path)) or
+                (filename.endswith('.npy') and is_valid_npy(path))):
+            views.add(filename[:-4])
+    return views
+
+
+def rss_mb(pid='self'):
+    """current resident memory of a process in MB. Falls back to the peak
+    memory of this process where /proc is not available"""
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    if pid != 'self' or resource is None:
+        return 0.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / 1024. / 1024.
+    return peak / 1024.
@@ -0,0 +1,245 @@
+"""Local render farm for phong_multi_for_rotnet.py.
+
+Blender does not release the memory of deleted objects, so long runs of
+the render script run out of memory. This supervisor splits the models
+list over several headless Blender workers. A worker renders at most
+--models-per-worker models and stops early once its memory (RSS) exceeds
+--max-rss, then a fresh worker takes over the remaining models. Models of
+crashed workers are retried. The render time of every model is collected
+in a summary:
+
+python render_farm.py <3d mesh list file> <save dir rotnet> -j 8 \
+    --max-rss 4000 -- --batch
+
+Arguments after "--" are passed on to phong_multi_for_rotnet.py.
+"""
+import sys
+import getopt
+import json
+import os
+import subprocess
+import time
+from collections import deque
+
+import render_common
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BLENDER = "blender"
+BLEND_FILE = os.path.join(SCRIPT_DIR, "phong.blend")
+RENDER_SCRIPT = os.path.join(SCRIPT_DIR, "phong_multi_for_rotnet.py")
+
+WORKERS = os.cpu_count() or 1
+MODELS_PER_WORKER = 10
+RETRIES = 2
+POLL_INTERVAL = 1.
+# a worker is killed if it grows this much above --max-rss within a model
+HARD_RSS_FACTOR = 1.5
+
+
+class Worker:
+    """one blender process rendering a chunk of the models"""
+
+    def __init__(self, number, models, work_dir, blender, save_dir,
+                 input_dir, max_rss, extra_args):
+        self.number = number
+        self.models = models
+        self.start = time.time()
+        name = "worker_%04d" % number
+        self.list_path = os.path.join(work_dir, name + ".txt")
+        self.progress_path = os.path.join(work_dir, name + ".progress")
+        self.log_path = os.path.join(work_dir, name + ".log")
+        with open(self.list_path, "w") as f:
+            f.write("\n".join(models) + "\n")
+        # the render script appends to the progress file and the worker
+        # numbers start at 0 again in every run
+        if os.path.isfile(self.progress_path):
+            os.remove(self.progress_path)
+
+        command = [blender, "-b", BLEND_FILE, "-P", RENDER_SCRIPT, "--",
+                   self.list_path, save_dir, "--input-dir", input_dir,
+                   "--progress", self.progress_path]
+        if max_rss is not None:
+            command += ["--max-rss", str(max_rss)]
+        command += extra_args
+
+        self.log = open(self.log_path, "w")
+        self.process = subprocess.Popen(command, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+
+    def progress(self):
+        """records written by the worker, one per finished model"""
+        records = []
+        if os.path.isfile(self.progress_path):
+            with open(self.progress_path) as f:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+        return records
+
+    def close(self):
+        self.log.close()
+
+
+def run_farm(models, save_dir, input_dir, workers=WORKERS,
+             models_per_worker=MODELS_PER_WORKER, max_rss=None,
+             retries=RETRIES, blender=BLENDER, extra_args=(), work_dir=None):
+    """render all models with a pool of recycled workers and return the
+    per-model results as model -> {status, seconds, attempts, rss_mb}"""
+    work_dir = work_dir or os.path.join(save_dir, ".render_farm")
+    os.makedirs(work_dir, exist_ok=True)
+
+    pending = deque(models)
+    attempts = {model: 0 for model in models}
+    results = {}
+    running = []
+    number = 0
+
+    while pending or running:
+        while pending and len(running) < workers:
+            chunk = [pending.popleft()
+                     for _ in range(min(models_per_worker, len(pending)))]
+            running.append(Worker(number, chunk, work_dir, blender, save_dir,
+                                  input_dir, max_rss, list(extra_args)))
+            print("Started worker %d with %d models" % (number, len(chunk)))
+            number += 1
+
+        time.sleep(POLL_INTERVAL)
+
+        for worker in list(running):
+            if worker.process.poll() is None:
+                if (max_rss is not None and
+                        render_common.rss_mb(worker.process.pid) >
+                        max_rss * HARD_RSS_FACTOR):
+                    print("Killing worker %d (pid %d), out of memory" % (
+                        worker.number, worker.process.pid))
+                    worker.process.kill()
+                continue
+
+            running.remove(worker)
+            worker.close()
+            records = {record["model"]: record
+                       for record in worker.progress()}
+            unfinished = [model for model in worker.models
+                          if model not in records]
+            recycled = (worker.process.returncode ==
+                        render_common.RECYCLE_EXIT_CODE)
+
+            for model in worker.models:
+                record = records.get(model)
+                if record is None:
+                    continue
+                attempts[model] += 1
+                if record["status"] == "done":
+                    results[model] = dict(record, attempts=attempts[model])
+                else:
+                    retry(model, record, attempts, retries, pending, results)
+
+            if unfinished and not recycled:
+                # the worker crashed while rendering the first unfinished
+                # model, the others were not started yet
+                model = unfinished.pop(0)
+                attempts[model] += 1
+                retry(model, {"model": model, "status": "crashed",
+                              "seconds": time.time() - worker.start},
+                      attempts, retries, pending, results)
+            pending.extend(unfinished)
+
+            print("Worker finished with code %d, %d of %d models done" % (
+                worker.process.returncode,
+                sum(r["status"] == "done" for r in results.values()),
+                len(models)))
+
+    return results
+
+
+def retry(model, record, attempts, retries, pending, results):
+    if attempts[model] <= retries:
+        print("Retrying %s after it %s" % (model, record["status"]))
+        pending.append(model)
+    else:
+        print("Giving up on %s" % model)
+        results[model] = dict(record, attempts=attempts[model])
+
+
+def summarize(results, wall_time):
+    done = [r for r in results.values() if r["status"] == "done"]
+    seconds = sorted(r["seconds"] for r in done)
+    summary = {
+        "models": len(results),
+        "done": len(done),
+        "failed": sorted(model for model, r in results.items()
+                         if r["status"] != "done"),
+        "wall_seconds": wall_time,
+        "render_seconds": sum(seconds),
+        "median_model_seconds": seconds[len(seconds) // 2] if seconds else 0,
+        "max_model_seconds": seconds[-1] if seconds else 0,
+        "results": results,
+    }
+    return summary
+
+
+def main(argv):
+    usage = ("render_farm.py <3d mesh list file> <save dir rotnet> "
+             "[-j <workers>] [-i <input dir>] "
+             "[--models-per-worker <number>] [--max-rss <MB>] "
+             "[--retries <number>] [--blender <executable>] "
+             "[-- <arguments of phong_multi_for_rotnet.py>]")
+    extra_args = []
+    if "--" in argv:
+        extra_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    try:
+        opts, args = getopt.gnu_getopt(argv, "hj:i:", [
+            "models-per-worker=", "max-rss=", "retries=", "blender="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    if len(args) != 2:
+        print(usage)
+        sys.exit(2)
+
+    models_list, save_dir = args
+    input_dir = os.path.dirname(os.path.abspath(models_list))
+    workers = WORKERS
+    models_per_worker = MODELS_PER_WORKER
+    max_rss = None
+    retries = RETRIES
+    blender = BLENDER
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        elif opt == "-j":
+            workers = int(arg)
+        elif opt == "-i":
+            input_dir = os.path.abspath(arg)
+        elif opt == "--models-per-worker":
+            models_per_worker = int(arg)
+        elif opt == "--max-rss":
+            max_rss = float(arg)
+        elif opt == "--retries":
+            retries = int(arg)
+        elif opt == "--blender":
+            blender = arg
+
+    with open(models_list) as f:
+        models = [model for model in f.read().splitlines() if model]
+
+    start = time.time()
+    results = run_farm(models, save_dir, input_dir, workers,
+                       models_per_worker, max_rss, retries, blender,
+                       extra_args)
+    summary = summarize(results, time.time() - start)
+
+    summary_path = os.path.join(save_dir, "render_farm_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print("%d of %d models rendered in %.0f s, summary in %s" % (
+        summary["done"], len(models), summary["wall_seconds"], summary_path))
+    if summary["failed"]:
+        print("Failed models: " + ", ".join(summary["failed"]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
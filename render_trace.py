@@ -0,0 +1,120 @@
+"""Timing trace of the render stages.
+
+A Tracer measures the wall time of every call of a stage (load, normalize,
+render, save, ...) and the throughput and memory after every model. With a
+path, every measurement is appended as one JSON line:
+
+{"type": "span", "stage": "render", "model": "bolt", "seconds": 0.41}
+{"type": "model", "model": "bolt", "views": 300, "views_per_second": ...
+
+and close() appends the summary of the run, which is also written to
+<path>.summary.json so that the summaries of runs with different renderer
+settings can be compared with diff.
+
+The module is imported by phong_multi_for_rotnet.py inside Blender, so it
+only uses the standard library and no syntax newer than Python 3.5.
+"""
+import json
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Collect stage timings, without a path nothing is written"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.model = None
+        self.views = 0
+        self.start = time.time()
+        self.stages = {}
+        self.models = []
+        self._file = open(path, 'a') if path is not None else None
+
+    def _write(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._file.flush()
+
+    @contextmanager
+    def span(self, stage, **fields):
+        """measure the wall time of the enclosed block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            stats = self.stages.setdefault(stage, [0, 0., 0.])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            record = dict(fields, type='span', stage=stage, seconds=seconds)
+            if self.model is not None:
+                record['model'] = self.model
+            self._write(record)
+
+    def begin_model(self, model):
+        self.model = model
+        self.views = 0
+
+    def count_views(self, views):
+        """add rendered views to the current model"""
+        self.views += views
+
+    def end_model(self, status, seconds, rss_mb, **fields):
+        """record the result of the current model"""
+        views = self.views
+        record = dict(fields, type='model', model=self.model, status=status,
+                      seconds=seconds, views=views, rss_mb=rss_mb,
+                      views_per_second=views / seconds if seconds > 0 else 0.)
+        self.models.append(record)
+        self._write(record)
+        self.model = None
+        return record
+
+    def summary(self):
+        wall = time.time() - self.start
+        views = sum(record['views'] for record in self.models)
+        rss = [record['rss_mb'] for record in self.models]
+        return {
+            'type': 'summary',
+            'wall_seconds': wall,
+            'models': len(self.models),
+            'failed': sum(record['status'] != 'done'
+                          for record in self.models),
+            'views': views,
+            'views_per_second': views / wall if wall > 0 else 0.,
+            'rss_mb': {'first': rss[0] if rss else 0.,
+                       'last': rss[-1] if rss else 0.,
+                       'max': max(rss) if rss else 0.},
+            'stages': dict(
+                (stage, {'calls': calls, 'seconds': total,
+                         'mean_seconds': total / calls,
+                         'max_seconds': longest})
+                for stage, (calls, total, longest) in self.stages.items()),
+        }
+
+    def print_summary(self, summary):
+        print('%d models, %d views in %.1f s (%.2f views/s), RSS %.0f -> '
+              '%.0f MB' % (summary['models'], summary['views'],
+                           summary['wall_seconds'],
+                           summary['views_per_second'],
+                           summary['rss_mb']['first'],
+                           summary['rss_mb']['last']))
+        for stage in sorted(summary['stages']):
+            stats = summary['stages'][stage]
+            print('  %-10s %6d calls %9.2f s total %8.4f s mean %8.4f s max'
+                  % (stage, stats['calls'], stats['seconds'],
+                     stats['mean_seconds'], stats['max_seconds']))
+
+    def close(self):
+        """write and print the summary of the run"""
+        summary = self.summary()
+        self.print_summary(summary)
+        if self._file is not None:
+            self._write(summary)
+            self._file.close()
+            self._file = None
+            with open(self.path + '.summary.json', 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+        return summary
@@ -1,87 +1,452 @@
+import sys
+import getopt
+import json
+import os
 import random
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 
-def makeString(prefix, tag, angle):
-    randomAngleArrayFor12Views = []
-    tempStoreString = ""
-    tempStr = []
-    string = ""
-
-    for i in range(1, 13):
-        randomAngleArrayFor12Views.append(i)
-    random.shuffle(randomAngleArrayFor12Views)
-    for j in range(1, 13):
-        if angle >= 100:
-            string += prefix + "_0" + str(angle) + "_"
-        elif angle >= 10:
-            string += prefix + "_00" + str(angle) + "_"
-        else:
-            string += prefix + "_000" + str(angle) + "_"
-        if (randomAngleArrayFor12Views[j-1] >= 10):
-            string += "0" + str(randomAngleArrayFor12Views[j-1]) + ".png"
+BASE_PATH = "/base/path/"
+DATA_SET_NAME = "random30"
+CLASS_LIST = "/path/to/random_30_classes.txt"
+TARGET_FILE = "path/to/training/file/list.txt"
+
+AMOUNT_OF_INSTANCES = 100
+NUM_VIEWS = 12
+WRITE_BUFFER_SIZE = 1 << 20
+SCAN_WORKERS = 16
+
+# <class>_<instance>_<view>.png as written by phong_multi_for_rotnet.py
+VIEW_PATTERN = re.compile(r"^(?P<prefix>.+)_(?P<instance>\d{4,})_"
+                          r"(?P<view>\d{3})\.png$")
+FULL_VIEW_MASK = (1 << NUM_VIEWS) - 1
+INDEX_NAME = ".render_index.json"
+SPLIT_NAMES = ["train", "val", "test"]
+
+# binary index: one record per view plus a string table of the prefixes
+RECORD_DTYPE = np.dtype([("prefix_id", "<u4"), ("instance", "<u4"),
+                         ("view", "<u2"), ("label", "<u2")])
+LINE_PATTERN = re.compile(r"^(?P<prefix>.+)_(?P<instance>\d{4,})_"
+                          r"(?P<view>\d{3})\.png (?P<label>\d+)$")
+CONVERT_CHUNK = 1 << 16
+
+
+def shuffled_views(rng=random):
+    views = list(range(1, NUM_VIEWS + 1))
+    rng.shuffle(views)
+    return views
+
+
+def makeString(prefix, tag, angle, rng=random, views=None):
+    """lines of the 12 views of one instance, in random view order"""
+    if views is None:
+        views = shuffled_views(rng)
+    return "".join(["%s_%04d_%03d.png %d\n" % (prefix, angle, view, tag)
+                    for view in views])
+
+
+def read_class_list(path):
+    with open(path, "r") as f:
+        return [line.rstrip() for line in f if line.strip()]
+
+
+def class_prefixes(classes, base_path=BASE_PATH,
+                   data_set_name=DATA_SET_NAME):
+    """path prefix of the rendered images of every class"""
+    return [base_path + "/" + data_set_name + "/" + name + "/" + name
+            for name in classes]
+
+
+def binary_index_paths(path):
+    """record and string table file of the binary index of a list file"""
+    root = os.path.splitext(path)[0]
+    return root + ".idx.npy", root + ".prefixes.txt"
+
+
+def write_prefixes(path, prefixes):
+    with open(path, "w") as f:
+        for prefix in prefixes:
+            f.write(prefix + "\n")
+
+
+def open_binary_index(path):
+    """prefixes and memory-mapped records of the binary index of a list.
+    The line of record i is
+    "%s_%04d_%03d.png %d" % (prefixes[prefix_id], instance, view, label)"""
+    records_path, prefixes_path = binary_index_paths(path)
+    with open(prefixes_path) as f:
+        prefixes = f.read().splitlines()
+    return prefixes, np.load(records_path, mmap_mode="r")
+
+
+def write_groups(target_path, prefixes, labels, instances, rng=random,
+                 binary=False):
+    """Write the lines of the given (label, instance) groups in shuffled
+    order. The lines are streamed to the file, only the group arrays and
+    their shuffled order are kept in memory, as 4 byte entries.
+    With binary, the same records are also written to a binary index."""
+    order = array("I", range(len(labels)))
+    rng.shuffle(order)
+
+    records = None
+    if binary:
+        records_path, prefixes_path = binary_index_paths(target_path)
+        write_prefixes(prefixes_path, prefixes)
+        records = np.lib.format.open_memmap(
+            records_path, mode="w+", dtype=RECORD_DTYPE,
+            shape=(len(order) * NUM_VIEWS,))
+
+    with open(target_path, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        for position, i in enumerate(order):
+            label = labels[i]
+            views = shuffled_views(rng)
+            f.write(makeString(prefixes[label], label, instances[i], rng,
+                               views))
+            if records is not None:
+                start = position * NUM_VIEWS
+                records[start:start + NUM_VIEWS] = [
+                    (label, instances[i], view, label) for view in views]
+
+    if records is not None:
+        records.flush()
+        del records
+
+    return len(order) * NUM_VIEWS
+
+
+def text_to_binary(text_path, binary_path=None):
+    """convert a text list into a binary index (next to binary_path)"""
+    binary_path = binary_path or text_path
+    with open(text_path) as f:
+        num_lines = sum(1 for line in f if line.strip())
+
+    records_path, prefixes_path = binary_index_paths(binary_path)
+    records = np.lib.format.open_memmap(records_path, mode="w+",
+                                        dtype=RECORD_DTYPE,
+                                        shape=(num_lines,))
+    prefix_ids = {}
+    chunk = []
+    position = 0
+    with open(text_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            match = LINE_PATTERN.match(line)
+            if match is None:
+                raise ValueError("Invalid list line: %s" % line)
+            prefix_id = prefix_ids.setdefault(match.group("prefix"),
+                                              len(prefix_ids))
+            chunk.append((prefix_id, int(match.group("instance")),
+                          int(match.group("view")), int(match.group("label"))))
+            if len(chunk) == CONVERT_CHUNK:
+                records[position:position + len(chunk)] = chunk
+                position += len(chunk)
+                chunk = []
+    records[position:position + len(chunk)] = chunk
+    records.flush()
+    del records
+
+    write_prefixes(prefixes_path, sorted(prefix_ids, key=prefix_ids.get))
+    return num_lines
+
+
+def binary_to_text(binary_path, text_path):
+    """convert a binary index back into a text list"""
+    prefixes, records = open_binary_index(binary_path)
+    with open(text_path, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        for start in range(0, len(records), CONVERT_CHUNK):
+            chunk = records[start:start + CONVERT_CHUNK]
+            f.write("".join(["%s_%04d_%03d.png %d\n" % (
+                prefixes[prefix_id], instance, view, label)
+                for prefix_id, instance, view, label in chunk.tolist()]))
+    return len(records)
+
+
+def write_list(target_path, prefixes, amount_of_instances=AMOUNT_OF_INSTANCES,
+               rng=random, binary=False):
+    """Write the shuffled list of all instances of all classes. The label of
+    a class is its position in prefixes."""
+    labels = array("I")
+    instances = array("I")
+    for label in range(len(prefixes)):
+        labels.extend([label] * amount_of_instances)
+        instances.extend(range(1, amount_of_instances + 1))
+    return write_groups(target_path, prefixes, labels, instances, rng,
+                        binary)
+
+
+def scan_class_dir(path, name):
+    """instance -> bit mask of the rendered views of one class folder"""
+    instances = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            match = VIEW_PATTERN.match(entry.name)
+            if match is None or match.group("prefix") != name:
+                continue
+            view = int(match.group("view"))
+            if 1 <= view <= NUM_VIEWS:
+                instance = int(match.group("instance"))
+                instances[instance] = (instances.get(instance, 0) |
+                                       1 << (view - 1))
+    return instances
+
+
+def build_render_index(root, workers=SCAN_WORKERS):
+    """Index of the rendered views below root, as
+    class -> instance -> bit mask of the existing views.
+    The index is cached in root together with the mtime of every class
+    folder, so only folders in which files were added, removed or renamed
+    since the last call are scanned again (in parallel)."""
+    cache_path = os.path.join(root, INDEX_NAME)
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    index = {}
+    outdated = []
+    with os.scandir(root) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            cached = cache.get(entry.name)
+            if cached is not None and cached["mtime_ns"] == mtime:
+                index[entry.name] = {int(instance): mask for instance, mask
+                                     in cached["instances"].items()}
+            else:
+                outdated.append((entry.name, entry.path, mtime))
+
+    if outdated or len(index) != len(cache):
+        print("Scanning %d of %d class folders" % (len(outdated),
+                                                   len(outdated) + len(index)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scanned = executor.map(
+                lambda item: scan_class_dir(item[1], item[0]), outdated)
+            for (name, _, mtime), instances in zip(outdated, scanned):
+                index[name] = instances
+                cache[name] = {"mtime_ns": mtime, "instances": instances}
+        cache = {name: cache[name] for name in index}
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_path + ".tmp", cache_path)
+
+    return index
+
+
+def find_holes(index, classes, amount_of_instances=None):
+    """list of (class, instance, missing views) of all incomplete groups.
+    Without amount_of_instances, the instances up to the highest rendered
+    one of a class are expected"""
+    holes = []
+    for name in classes:
+        instances = index.get(name, {})
+        expected = amount_of_instances
+        if expected is None:
+            expected = max(instances) if instances else 0
+        for instance in range(1, expected + 1):
+            mask = instances.get(instance, 0)
+            if mask != FULL_VIEW_MASK:
+                missing = [view for view in range(1, NUM_VIEWS + 1)
+                           if not mask & 1 << (view - 1)]
+                holes.append((name, instance, missing))
+    return holes
+
+
+def report_holes(holes):
+    for name, instance, missing in holes:
+        if len(missing) == NUM_VIEWS:
+            print("Missing instance %s_%04d" % (name, instance))
         else:
-            string += "00" + str(randomAngleArrayFor12Views[j-1]) + ".png"
-        string += " " + str(tag)
-        string += '\n'
+            print("Incomplete instance %s_%04d, missing views %s" % (
+                name, instance, ", ".join(str(view) for view in missing)))
+    print("%d incomplete or missing instances" % len(holes))
 
-    tempStr.append(string)
 
-    for k in range(0, tempStr.__len__()):
-        tempStoreString += tempStr[k]
+def complete_instances(index, classes):
+    """sorted instances with all views rendered, for every class"""
+    return [sorted(instance for instance, mask in index.get(name, {}).items()
+                   if mask == FULL_VIEW_MASK)
+            for name in classes]
 
-    # print(tempStoreString)
-    return tempStoreString
 
+def write_list_from_index(target_path, classes, prefixes, index, rng=random,
+                          binary=False):
+    """Write the shuffled list of all instances with all views rendered"""
+    labels = array("I")
+    instances = array("I")
+    for label, complete in enumerate(complete_instances(index, classes)):
+        labels.extend([label] * len(complete))
+        instances.extend(complete)
+    return write_groups(target_path, prefixes, labels, instances, rng,
+                        binary)
 
-base_path = "/base/path/"
-data_set_name = "random30"
 
-AMOUNT_OF_INSTANCES = 100
+def valid_split(ratios, num_shards):
+    """ratios (None or 1 to len(SPLIT_NAMES) values) must be non-negative
+    with a positive sum and there must be at least one shard"""
+    if num_shards < 1:
+        return False
+    if ratios is None:
+        return True
+    return (1 <= len(ratios) <= len(SPLIT_NAMES) and
+            min(ratios) >= 0 and sum(ratios) > 0)
+
+
+def split_groups(instances_per_class, ratios, num_shards, rng):
+    """Split the instances of every class by the ratios (stratified) and
+    distribute every split round robin over num_shards shards, so the
+    shards differ by at most one instance in total and per class. The
+    views of an instance always stay together.
+    Returns splits[split][shard] = (labels, instances)."""
+    total = float(sum(ratios))
+    splits = [[(array("I"), array("I")) for _ in range(num_shards)]
+              for _ in ratios]
+    next_shard = [0] * len(ratios)
+
+    for label, instances in enumerate(instances_per_class):
+        instances = list(instances)
+        rng.shuffle(instances)
+        start = 0
+        cumulative = 0.
+        for s, ratio in enumerate(ratios):
+            cumulative += ratio
+            end = int(round(cumulative / total * len(instances)))
+            for i, instance in enumerate(instances[start:end]):
+                shard = (next_shard[s] + i) % num_shards
+                splits[s][shard][0].append(label)
+                splits[s][shard][1].append(instance)
+            next_shard[s] = (next_shard[s] + end - start) % num_shards
+            start = end
+
+    return splits
+
+
+def split_list_path(target_path, split_name, shard, num_shards):
+    root, ext = os.path.splitext(target_path)
+    path = root + "_" + split_name
+    if num_shards > 1:
+        path += "_shard%02d" % shard
+    return path + ext
+
+
+def write_split_lists(target_path, prefixes, instances_per_class, ratios,
+                      num_shards=1, rng=random, binary=False):
+    """Write one list per split and shard, e.g. list_train_shard00.txt.
+    With a seeded rng the result only depends on the seed."""
+    splits = split_groups(instances_per_class, ratios, num_shards, rng)
+    written = {}
+    for split_name, shards in zip(SPLIT_NAMES, splits):
+        for shard, (labels, instances) in enumerate(shards):
+            path = split_list_path(target_path, split_name, shard, num_shards)
+            written[path] = write_groups(path, prefixes, labels, instances,
+                                         rng, binary)
+    return written
+
+
+def main(argv):
+    usage = ("rotnet_list_creation.py [-c <class list>] [-o <list file>] "
+             "[-b <base path>] [-d <data set name>] [-n <instances>] "
+             "[--index] [-j <scan workers>] [--seed <seed>] "
+             "[--split <train,val[,test] ratios>] [--shards <number>] "
+             "[--binary] [--to-binary <list file>] [--to-text <list file>]")
+    try:
+        opts, args = getopt.getopt(argv, "hc:o:b:d:n:j:",
+                                   ["index", "seed=", "split=", "shards=",
+                                    "binary", "to-binary=", "to-text="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    class_list = CLASS_LIST
+    target_file = TARGET_FILE
+    base_path = BASE_PATH
+    data_set_name = DATA_SET_NAME
+    amount_of_instances = AMOUNT_OF_INSTANCES
+    # without -n, the holes are searched up to the highest rendered
+    # instance of every class
+    expected_instances = None
+    use_index = False
+    workers = SCAN_WORKERS
+    seed = None
+    ratios = None
+    num_shards = 1
+    binary = False
+    to_binary = None
+    to_text = None
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        elif opt == "-c":
+            class_list = arg
+        elif opt == "-o":
+            target_file = arg
+        elif opt == "-b":
+            base_path = arg
+        elif opt == "-d":
+            data_set_name = arg
+        elif opt == "-n":
+            amount_of_instances = int(arg)
+            expected_instances = amount_of_instances
+        elif opt == "--index":
+            use_index = True
+        elif opt == "-j":
+            workers = int(arg)
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--split":
+            ratios = [float(ratio) for ratio in arg.split(",")]
+        elif opt == "--shards":
+            num_shards = int(arg)
+        elif opt == "--binary":
+            binary = True
+        elif opt == "--to-binary":
+            to_binary = arg
+        elif opt == "--to-text":
+            to_text = arg
+    if not valid_split(ratios, num_shards):
+        print(usage)
+        sys.exit(2)
+
+    if to_binary is not None:
+        # binary index next to an existing text list
+        print(text_to_binary(to_binary))
+        return
+    if to_text is not None:
+        # text list from the binary index next to to_text
+        print(binary_to_text(to_text, target_file))
+        return
+
+    rng = random.Random(seed)
+    classes = read_class_list(class_list)
+    prefixes = class_prefixes(classes, base_path, data_set_name)
+    if use_index:
+        # only list instances for which all views were actually rendered
+        index = build_render_index(base_path + "/" + data_set_name, workers)
+        report_holes(find_holes(index, classes, expected_instances))
+        instances_per_class = complete_instances(index, classes)
+    else:
+        instances_per_class = [range(1, amount_of_instances + 1)
+                               for _ in classes]
+
+    if ratios is not None or num_shards > 1:
+        written = write_split_lists(target_file, prefixes,
+                                    instances_per_class, ratios or [1.],
+                                    num_shards, rng, binary)
+        for path in sorted(written):
+            print(path, written[path])
+    elif use_index:
+        print(write_list_from_index(target_file, classes, prefixes, index,
+                                    rng, binary))
+    else:
+        print(write_list(target_file, prefixes, amount_of_instances, rng,
+                         binary))
+    print("OK")
+
 
-filePath = []
-file1 = open('/path/to/random_30_classes.txt', 'r')
-Lines = file1.readlines()
-count = 0
-# filePath contains the pathes to all classes
-for line in Lines:
-    filePath.append(base_path + "/" + data_set_name +
-                    "/" + line.rstrip() + "/" + line.rstrip())
-
-
-# angleArray contains the values from 1 to "amount_of_instances"
-angleArray = []
-for angle in range(1, AMOUNT_OF_INSTANCES + 1):
-    angleArray.append(angle)
-
-
-# dictionary containing the label of each class
-labelMap = dict()
-for i in range(0, filePath.__len__()):
-    labelMap[filePath[i]] = i % Lines.__len__() + 1
-
-randomAngleArrayFor12Views = []
-random.shuffle(filePath)
-random.shuffle(angleArray)
-fileAndAngle = []
-
-for file in range(0, filePath.__len__()):
-    for angle in range(0, angleArray.__len__()):
-        key = filePath[file]
-        value = str(angleArray[angle])
-        fileAndAngle.append((key, value))
-
-random.shuffle(fileAndAngle)
-print(fileAndAngle.__len__())
-
-mainStringOutput = ""
-for item in fileAndAngle:
-    prefix = item[0]
-    tag = labelMap[prefix]
-    angle = int(item[1])
-    mainStringOutput += makeString(prefix, tag-1, angle)
-
-target_file = open("path/to/training/file/list.txt", "w")
-target_file.write(mainStringOutput)
-target_file.close()
-
-print("OK")
+if __name__ == "__main__":
+    main(sys.argv[1:])
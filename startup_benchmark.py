@@ -0,0 +1,116 @@
+"""Start-up cost of the worker modules.
+
+Every pool worker of pipeline.py and render_farm.py imports the module of
+its stage first. For every module, a fresh interpreter is started that
+only imports it, and the import time, the resident memory after the import
+and the heavy dependencies that were loaded are reported (median of the
+repeats):
+
+python startup_benchmark.py [-r <repeats>] [-o <result json>] [module ...]
+
+Modules that fail to import (missing dependencies) are reported with the
+error instead of the timings.
+"""
+import sys
+import getopt
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+MODULES = ("image_augmentation", "calculate_physically_sound_orientations",
+           "calculate_random_orientations", "orientation_kernels",
+           "compact_mesh", "rotnet_list_creation", "numpy_renderer",
+           "view_dedup", "pipeline")
+HEAVY_MODULES = ("cv2", "matplotlib", "albumentations", "imgaug", "trimesh",
+                 "scipy", "numba")
+NUM_REPEATS = 5
+# the child imports the modules from here, wherever the benchmark is run
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# run in the child interpreter, render_common only needs the standard
+# library and is imported before the baseline is measured
+CHILD = """
+import json
+import sys
+import time
+from render_common import rss_mb
+before = rss_mb()
+start = time.perf_counter()
+error = None
+try:
+    __import__(sys.argv[1])
+except Exception as e:
+    error = '%s: %s' % (type(e).__name__, e)
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'rss_mb': rss_mb(),
+                  'rss_before_mb': before, 'error': error,
+                  'loaded': [name for name in sys.argv[2:]
+                             if name in sys.modules]}))
+"""
+
+
+def measure(module, python=sys.executable):
+    """one import of module in a new interpreter"""
+    output = subprocess.check_output(
+        [python, "-c", CHILD, module] + list(HEAVY_MODULES), cwd=SCRIPT_DIR)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def benchmark(module, repeats):
+    runs = [measure(module) for _ in range(repeats)]
+    if runs[0]["error"] is not None:
+        return {"error": runs[0]["error"]}
+    rss = statistics.median(run["rss_mb"] for run in runs)
+    return {
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "min_seconds": min(run["seconds"] for run in runs),
+        "rss_mb": rss,
+        "import_rss_mb": rss - statistics.median(run["rss_before_mb"]
+                                                 for run in runs),
+        "loaded": runs[0]["loaded"],
+    }
+
+
+def main(argv):
+    usage = ("startup_benchmark.py [-r <repeats>] [-o <result json>] "
+             "[module ...]")
+    try:
+        opts, args = getopt.gnu_getopt(argv, "hr:o:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    repeats = NUM_REPEATS
+    outputpath = None
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        elif opt == "-r":
+            repeats = int(arg)
+        elif opt == "-o":
+            outputpath = arg
+    modules = args or MODULES
+
+    results = {}
+    for module in modules:
+        result = benchmark(module, repeats)
+        results[module] = result
+        if "error" in result:
+            print("%-40s %s" % (module, result["error"]))
+            continue
+        print("%-40s %7.3f s %7.1f MB (+%.1f MB)  %s" % (
+            module, result["seconds"], result["rss_mb"],
+            result["import_rss_mb"], ", ".join(result["loaded"]) or "-"))
+
+    if outputpath is not None:
+        with open(outputpath, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "repeats": repeats, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
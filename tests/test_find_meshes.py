@@ -0,0 +1,48 @@
+"""The meshes of a folder that the pipeline and the orientation scripts
+work on."""
+import contextlib
+import io
+
+import pytest
+
+pytest.importorskip("trimesh")
+
+import compact_mesh  # noqa: E402
+import pipeline  # noqa: E402
+
+
+def touch(folder, *names):
+    for name in names:
+        (folder / name).write_text("")
+
+
+def test_only_mesh_formats(tmp_path):
+    touch(tmp_path, "a.obj", "b.STL", "c.ply", "notes.txt", "a_poses.json",
+          "scene.tar.bz2")
+    (tmp_path / "d.obj").mkdir()
+    assert compact_mesh.find_meshes(str(tmp_path)) == {
+        "a": "a.obj", "b": "b.STL", "c": "c.ply", "scene": "scene.tar.bz2"}
+
+
+def test_base_mesh_only_next_to_its_model(tmp_path):
+    touch(tmp_path, "x.obj", "x_base.obj", "y_base.stl")
+    assert compact_mesh.find_meshes(str(tmp_path)) == {
+        "x": "x.obj", "y_base": "y_base.stl"}
+
+
+def test_duplicate_models_warn(tmp_path):
+    touch(tmp_path, "foo.obj", "foo.stl")
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        meshes = compact_mesh.find_meshes(str(tmp_path))
+    assert meshes == {"foo": "foo.obj"}
+    assert "foo.obj and foo.stl" in output.getvalue()
+
+
+@pytest.mark.parametrize("args", (["--shards", "0"], ["--split", "0,0"],
+                                  ["--split", "1,-1"]))
+def test_invalid_split_exits_with_usage(args, tmp_path, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        pipeline.main([str(tmp_path), str(tmp_path / "out")] + args)
+    assert exit_info.value.code == 2
+    assert capsys.readouterr().out.startswith("pipeline.py")
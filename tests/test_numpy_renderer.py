@@ -0,0 +1,74 @@
+"""Regression check of numpy_renderer.py against checked-in reference
+renders of three small meshes. After an intended change of the renderer,
+the references are written again with
+
+PYTHONPATH=. python tests/test_numpy_renderer.py --update
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("trimesh")
+
+import numpy_renderer  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                        "numpy_renderer")
+MESHES = ("box", "cylinder", "cone")
+# (theta, phi) of the reference views
+VIEWS = ((45, 0), (45, 120), (35, 250))
+MIN_IOU = numpy_renderer.MIN_SILHOUETTE_IOU
+MIN_PSNR = 35.
+# mean absolute gray value difference on the object, the white background
+# hides changes of the shading in the PSNR
+MAX_OBJECT_ERROR = 2.
+
+
+def reference_name(mesh, coord):
+    return "%s_%03d_%03d.png" % (mesh, coord[0], coord[1])
+
+
+def object_error(reference, image):
+    reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY).astype(float)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(float)
+    background = numpy_renderer.BACKGROUND
+    on_object = (reference != background) | (image != background)
+    return np.abs(reference - image)[on_object].mean()
+
+
+def render(mesh, coord):
+    """BGR render like the files written by numpy_renderer.save"""
+    vertices, faces = numpy_renderer.load_normalized_mesh(
+        os.path.join(DATA_DIR, mesh + ".obj"))
+    return numpy_renderer.render_view(vertices, faces, coord)
+
+
+@pytest.mark.parametrize("mesh", MESHES)
+@pytest.mark.parametrize("coord", VIEWS)
+def test_matches_reference(mesh, coord):
+    reference = cv2.imread(os.path.join(DATA_DIR,
+                                        reference_name(mesh, coord)))
+    assert reference is not None
+    image = render(mesh, coord)
+    psnr, iou = numpy_renderer.image_similarity(reference, image)
+    assert iou >= MIN_IOU
+    assert psnr >= MIN_PSNR
+    assert object_error(reference, image) <= MAX_OBJECT_ERROR
+
+
+def update_references():
+    for mesh in MESHES:
+        for coord in VIEWS:
+            path = os.path.join(DATA_DIR, reference_name(mesh, coord))
+            cv2.imwrite(path, render(mesh, coord))
+            print("save to " + path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["--update"]:
+        print("test_numpy_renderer.py --update")
+        sys.exit(2)
+    update_references()
@@ -0,0 +1,34 @@
+"""Parity of the orientation kernels with the python implementation of
+calculate_physically_sound_orientations.py, for float64 and float32
+points. The compiled kernels are only checked with numba installed."""
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import orientation_kernels  # noqa: E402
+
+
+def check(seed, dtype):
+    pts, hull = orientation_kernels.random_hull(orientation_kernels.POINTS,
+                                                seed)
+    # facets standing vertically divide by zero in the stability check
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return orientation_kernels.check_parity(pts.astype(dtype), hull)
+
+
+@pytest.mark.parametrize("seed", orientation_kernels.PARITY_SEEDS)
+@pytest.mark.parametrize("dtype", orientation_kernels.PARITY_DTYPES)
+def test_kernels_match_python(seed, dtype):
+    assert check(seed, dtype) == []
+
+
+@pytest.mark.parametrize("seed", orientation_kernels.PARITY_SEEDS)
+@pytest.mark.parametrize("dtype", orientation_kernels.PARITY_DTYPES)
+def test_compiled_kernels_match_python(seed, dtype):
+    pytest.importorskip("numba")
+    assert orientation_kernels.ENABLED
+    assert check(seed, dtype) == []
+    # the kernel results came from numba, not from the python functions
+    assert orientation_kernels.group_facets.compiled is not None
+    assert orientation_kernels.first_stable_simplex.compiled is not None
@@ -0,0 +1,65 @@
+"""The poses chosen by calculate_physically_sound_orientations.py must stay
+those of the float64 baseline. baseline_poses.json was written by the
+trimesh based implementation (before CompactMesh) for the meshes in
+tests/data/orientations."""
+import contextlib
+import io
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+pytest.importorskip("trimesh")
+
+import calculate_physically_sound_orientations as orientations  # noqa: E402
+import calculate_random_orientations as random_orientations  # noqa: E402
+import compact_mesh  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                        "orientations")
+MESHES = ("box", "cylinder", "annulus", "capsule")
+
+with open(os.path.join(DATA_DIR, "baseline_poses.json")) as f:
+    BASELINE = json.load(f)
+
+
+def chosen_poses(mesh, tmp_path):
+    """orientation name -> 4x4 pose of a copy of the mesh in tmp_path"""
+    path = str(tmp_path / (mesh + ".obj"))
+    shutil.copy(os.path.join(DATA_DIR, mesh + ".obj"), path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        orientations.create_training_orientations(path)
+    with open(str(tmp_path / (mesh + "_poses.json"))) as f:
+        return json.load(f)["poses"]
+
+
+def test_stored_vertices_are_float32():
+    path = os.path.join(DATA_DIR, "box.obj")
+    mesh, _ = compact_mesh.load_mesh_to_origin(path)
+    assert mesh.vertices.dtype == np.float32
+    assert mesh.transformed(np.identity(4)).vertices.dtype == np.float32
+    mesh = orientations.load_mesh_and_move_to_origin(path)
+    assert mesh.vertices.dtype == np.float64
+
+
+def test_random_orientations(tmp_path):
+    path = str(tmp_path / "box.obj")
+    shutil.copy(os.path.join(DATA_DIR, "box.obj"), path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        random_orientations.create_training_orientations(path)
+    with open(str(tmp_path / "box_poses.json")) as f:
+        poses = json.load(f)["poses"]
+    assert len(poses) == random_orientations.MAX_COUNTER
+    assert sorted(os.listdir(str(tmp_path / "box"))) == sorted(
+        name + ".obj" for name in poses)
+
+
+@pytest.mark.parametrize("mesh", MESHES)
+def test_poses_match_float64_baseline(mesh, tmp_path):
+    poses = chosen_poses(mesh, tmp_path)
+    assert sorted(poses) == sorted(BASELINE[mesh])
+    for name, pose in BASELINE[mesh].items():
+        np.testing.assert_allclose(poses[name], pose, rtol=0, atol=1e-9)
@@ -0,0 +1,46 @@
+"""The base mesh and poses written for --single-import must give the same
+(centered, unit size) meshes as the exported orientation files."""
+import contextlib
+import io
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+trimesh = pytest.importorskip("trimesh")
+pytest.importorskip("scipy")
+
+import calculate_physically_sound_orientations as orientations  # noqa: E402
+import render_common  # noqa: E402
+from numpy_renderer import normalize_vertices  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                        "orientations")
+
+
+def load_vertices(path):
+    # process=False keeps the vertex order of the file
+    return np.asarray(trimesh.load(path, process=False).vertices)
+
+
+@pytest.mark.parametrize("mesh", ("box", "cylinder", "capsule"))
+def test_poses_reproduce_orientations(mesh, tmp_path):
+    path = str(tmp_path / (mesh + ".obj"))
+    shutil.copy(os.path.join(DATA_DIR, mesh + ".obj"), path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        orientations.create_training_orientations(path)
+    with open(str(tmp_path / (mesh + "_poses.json"))) as f:
+        sidecar = json.load(f)
+
+    base = load_vertices(str(tmp_path / sidecar["base"]))
+    names = sorted(sidecar["poses"])
+    matrices = render_common.normalized_poses(
+        base, [sidecar["poses"][name] for name in names])
+    assert names
+    for name, matrix in zip(names, matrices):
+        posed = np.dot(np.c_[base, np.ones(len(base))], matrix.T)[:, :3]
+        exported = load_vertices(str(tmp_path / mesh / (name + ".obj")))
+        np.testing.assert_allclose(posed, normalize_vertices(exported),
+                                   rtol=0, atol=1e-6)
@@ -0,0 +1,52 @@
+"""Views hashed while rendering must get the hash of the PNG saved from
+them, so the two modes of view_dedup.py find the same duplicates."""
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+import image_writer  # noqa: E402
+import view_dedup  # noqa: E402
+
+
+def blender_pixels(shift=0):
+    """linear RGBA floats, bottom row first, of a shaded object that is
+    not symmetric upside down"""
+    y, x = np.mgrid[0:240, 0:320].astype(np.float32)
+    pixels = np.full((240, 320, 4), 0.05, dtype=np.float32)
+    pixels[..., 3] = 1.
+    inside = (((x - 160 - shift) / 90.) ** 2 + ((y - 100) / 60.) ** 2 < 1) \
+        | ((abs(x - 160 - shift) < 15) & (y > 100) & (y < 200))
+    for channel, weight in enumerate((0.8, 0.5, 0.3)):
+        pixels[..., channel][inside] = weight * (y[inside] / 240.) ** 2
+    return pixels
+
+
+@pytest.mark.parametrize("shift", (0, 40))
+def test_render_hash_matches_png_hash(shift, tmp_path):
+    pixels = blender_pixels(shift)
+    path = str(tmp_path / "view.png")
+    with open(path, "wb") as f:
+        f.write(image_writer.encode_png(image_writer.to_display(pixels)))
+
+    deduplicator = view_dedup.GroupDeduplicator()
+    deduplicator.add_view(pixels)
+    assert deduplicator.current == [view_dedup.phash(
+        view_dedup.read_gray(path))]
+
+
+def test_flipped_view_differs():
+    pixels = blender_pixels()
+    deduplicator = view_dedup.GroupDeduplicator()
+    deduplicator.add_view(pixels)
+    deduplicator.add_view(pixels[::-1])
+    first, flipped = deduplicator.current
+    assert view_dedup.popcount(first ^ flipped) > view_dedup.THRESHOLD
+
+
+@pytest.mark.parametrize("args", (["--delete"], ["--prune-list", "x.txt"]))
+def test_removing_groups_needs_threshold(args, tmp_path, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        view_dedup.main([str(tmp_path)] + args)
+    assert exit_info.value.code == 2
+    assert "need -t" in capsys.readouterr().out
@@ -0,0 +1,331 @@
+"""Find near-duplicate instances among the rendered views.
+
+get_rot_num spreads the instances of a model over its orientations with
+small azimuth steps, so for compact or rotationally symmetric orientations
+many 12-view groups look the same. Every view is cropped to the bounding
+square of the object and gets a DCT perceptual hash (pHash, 64 bit). Two
+groups are near-duplicates if the mean Hamming distance of their views is
+at most the threshold, for the best cyclic shift of the 12 azimuth
+positions (a rotated copy of a group is a duplicate as well). Groups are
+clustered greedily per model: the first group of a cluster is kept, the
+others are removed.
+
+python view_dedup.py <render dir> [-t <bits>] [-r <report.json>] \
+    [--prune-list <list> -o <pruned list>] [--delete]
+
+Without -t only the report is written (at THRESHOLD), pruning the list or
+deleting the groups needs an explicit -t.
+
+phong_multi_for_rotnet.py uses GroupDeduplicator with --dedup-threshold
+to skip the remaining rotation steps of an orientation while rendering,
+so this module only uses the standard library, NumPy and no syntax newer
+than Python 3.5.
+"""
+import sys
+import getopt
+import json
+import os
+import re
+
+import numpy
+
+from image_writer import to_display
+
+NUM_VIEWS = 12
+DCT_SIZE = 32
+HASH_SIZE = 8
+# gray values (0..1) closer than this to the corner pixel are background
+BACKGROUND_TOLERANCE = 8 / 255.
+# mean number of differing hash bits per view. On numpy renders of a box,
+# a block, a cylinder and a cone (300 groups each), distinct poses were at
+# least 19 bits apart. The groups of one pose are rotated by less than a
+# view step and close: 2 bits removes 64 to 225 of the 300 groups, 10 bits
+# 285 to 289. Even 0 (equal hashes) removes 22 to 182
+THRESHOLD = 2.
+
+VIEW_PATTERN = re.compile(r'^(?P<prefix>.+)_(?P<instance>\d{4,})_'
+                          r'(?P<view>\d{3})\.png$')
+LIST_PATTERN = re.compile(r'^(?P<prefix>.+)_(?P<instance>\d{4,})_'
+                          r'(?P<view>\d{3})\.png\s')
+
+
+def _dct_matrix(size):
+    k = numpy.arange(size)[:, None]
+    n = numpy.arange(size)[None, :]
+    return numpy.cos(numpy.pi * (2 * n + 1) * k / (2. * size))
+
+
+DCT = _dct_matrix(DCT_SIZE)
+
+
+def crop_to_object(gray, tolerance=BACKGROUND_TOLERANCE):
+    """Square crop around the object, the pixels that differ from the
+    corner (background) color. The part only covers a few percent of the
+    frame, without the crop it would be a few pixels after downsample"""
+    gray = numpy.asarray(gray, dtype=numpy.float64)
+    background = gray[0, 0]
+    mask = numpy.abs(gray - background) > tolerance
+    rows = numpy.nonzero(mask.any(axis=1))[0]
+    cols = numpy.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        return gray
+    height = rows[-1] + 1 - rows[0]
+    width = cols[-1] + 1 - cols[0]
+    # pad to a square to keep the aspect ratio of the object
+    side = max(height, width)
+    square = numpy.full((side, side), background)
+    top = (side - height) // 2
+    left = (side - width) // 2
+    square[top:top + height, left:left + width] = gray[
+        rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return square
+
+
+def downsample(gray, size=DCT_SIZE):
+    """area average of a 2d image to size x size"""
+    gray = numpy.asarray(gray, dtype=numpy.float64)
+    if min(gray.shape) < size:
+        # nearest neighbour upsample of small crops first
+        factor = -(-size // min(gray.shape))
+        gray = gray.repeat(factor, axis=0).repeat(factor, axis=1)
+    rows = numpy.linspace(0, gray.shape[0], size + 1).astype(int)[:-1]
+    cols = numpy.linspace(0, gray.shape[1], size + 1).astype(int)[:-1]
+    sums = numpy.add.reduceat(numpy.add.reduceat(gray, rows, axis=0),
+                              cols, axis=1)
+    counts = numpy.outer(numpy.diff(numpy.append(rows, gray.shape[0])),
+                         numpy.diff(numpy.append(cols, gray.shape[1])))
+    return sums / counts
+
+
+def luminance(image):
+    """gray image (0..1) of an 8 bit RGB(A) image as saved in the PNGs"""
+    image = numpy.asarray(image, dtype=numpy.float64)
+    return numpy.dot(image[..., :3], [0.2126, 0.7152, 0.0722]) / 255.
+
+
+def phash(gray):
+    """64 bit DCT perceptual hash of the object in a 2d image (0..1)"""
+    coefficients = DCT.dot(downsample(crop_to_object(gray))).dot(DCT.T)
+    low = coefficients[:HASH_SIZE, :HASH_SIZE].ravel()
+    # the DC term only depends on the brightness
+    bits = low > numpy.median(low[1:])
+    return numpy.packbits(bits).view('>u8')[0].astype(numpy.uint64)
+
+
+def popcount(values):
+    values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+    bits = numpy.unpackbits(values[..., None].view(numpy.uint8), axis=-1)
+    return bits.sum(axis=-1)
+
+
+def group_distances(group, representatives):
+    """mean Hamming distance per view between a group (NUM_VIEWS hashes)
+    and every representative group (n x NUM_VIEWS), for the best cyclic
+    shift of the views"""
+    group = numpy.asarray(group, dtype=numpy.uint64)
+    representatives = numpy.asarray(representatives, dtype=numpy.uint64)
+    # shifts x representatives x views
+    shifted = numpy.stack([numpy.roll(group, shift)
+                           for shift in range(len(group))])
+    distances = popcount(shifted[:, None, :] ^ representatives[None, :, :])
+    return distances.mean(axis=2).min(axis=0)
+
+
+class GroupDeduplicator:
+    """greedy clustering of the view groups of one model"""
+
+    def __init__(self, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.representatives = []
+        self.instances = []
+        self.current = []
+
+    def reset(self):
+        self.representatives = []
+        self.instances = []
+        self.current = []
+
+    def add_group(self, hashes, instance=None):
+        """Returns the instance of the earlier group this group duplicates,
+        or None if it starts a new cluster"""
+        if self.representatives:
+            distances = group_distances(hashes, self.representatives)
+            best = int(numpy.argmin(distances))
+            if distances[best] <= self.threshold:
+                return self.instances[best]
+        self.representatives.append(numpy.asarray(hashes, numpy.uint64))
+        self.instances.append(instance)
+        return None
+
+    def add_view(self, pixels):
+        """collect the hash of a rendered view of the current group. pixels
+        are the linear, bottom row first RGBA floats of blender, they are
+        hashed like the PNG saved from them"""
+        self.current.append(phash(luminance(to_display(pixels, 3))))
+
+    def end_group(self, instance=None):
+        """True if the views added since the last call duplicate an earlier
+        group"""
+        hashes, self.current = self.current, []
+        if len(hashes) != NUM_VIEWS:
+            return False
+        return self.add_group(hashes, instance) is not None
+
+
+def read_gray(path):
+    """gray image of a rendered view in 0..1 like luminance"""
+    import cv2
+    return luminance(cv2.imread(path, cv2.IMREAD_COLOR)[..., ::-1])
+
+
+def model_groups(model_dir):
+    """instance -> {view: path} of the rendered views of a model folder"""
+    groups = {}
+    for filename in os.listdir(model_dir):
+        match = VIEW_PATTERN.match(filename)
+        if match is not None:
+            groups.setdefault(int(match.group('instance')), {})[
+                int(match.group('view'))] = os.path.join(model_dir, filename)
+    return groups
+
+
+def dedup_model(model_dir, threshold=THRESHOLD):
+    """instance -> instance it duplicates (None if kept) for all complete
+    groups of a model, in the order of the instances"""
+    deduplicator = GroupDeduplicator(threshold)
+    result = {}
+    for instance, views in sorted(model_groups(model_dir).items()):
+        if sorted(views) != list(range(1, NUM_VIEWS + 1)):
+            continue
+        hashes = [phash(read_gray(views[view]))
+                  for view in range(1, NUM_VIEWS + 1)]
+        result[instance] = deduplicator.add_group(hashes, instance)
+    return result
+
+
+def dedup_renders(render_dir, threshold=THRESHOLD):
+    """model -> instance -> duplicated instance for all model folders"""
+    return dict((name, dedup_model(os.path.join(render_dir, name),
+                                   threshold))
+                for name in sorted(os.listdir(render_dir))
+                if os.path.isdir(os.path.join(render_dir, name)))
+
+
+def make_report(duplicates, threshold):
+    models = {}
+    for model, instances in duplicates.items():
+        removed = dict((str(instance), kept)
+                       for instance, kept in instances.items()
+                       if kept is not None)
+        models[model] = {'groups': len(instances),
+                         'removed': len(removed),
+                         'duplicates': removed}
+    groups = sum(model['groups'] for model in models.values())
+    removed = sum(model['removed'] for model in models.values())
+    return {'threshold': threshold, 'groups': groups, 'removed': removed,
+            'removed_fraction': removed / float(groups) if groups else 0.,
+            'models': models}
+
+
+def removed_groups(duplicates):
+    return set((model, instance)
+               for model, instances in duplicates.items()
+               for instance, kept in instances.items() if kept is not None)
+
+
+def prune_list(list_path, pruned_path, removed):
+    """copy a training list without the lines of removed groups. Returns
+    the number of removed lines"""
+    dropped = 0
+    with open(list_path) as source, open(pruned_path, 'w') as target:
+        for line in source:
+            match = LIST_PATTERN.match(line)
+            if match is not None:
+                model = os.path.basename(match.group('prefix'))
+                if (model, int(match.group('instance'))) in removed:
+                    dropped += 1
+                    continue
+            target.write(line)
+    return dropped
+
+
+def delete_groups(render_dir, removed):
+    deleted = 0
+    for model, instance in sorted(removed):
+        model_dir = os.path.join(render_dir, model)
+        for view in range(1, NUM_VIEWS + 1):
+            path = os.path.join(model_dir, '%s_%04d_%03d.png' % (
+                model, instance, view))
+            if os.path.isfile(path):
+                os.remove(path)
+                deleted += 1
+    return deleted
+
+
+def main(argv):
+    usage = ('view_dedup.py <render dir> [-t <mean differing bits>] '
+             '[-r <report file>] [--prune-list <list> -o <pruned list>] '
+             '[--delete]')
+    try:
+        opts, args = getopt.gnu_getopt(argv, 'ht:r:o:',
+                                       ['prune-list=', 'delete'])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    if len(args) != 1:
+        print(usage)
+        sys.exit(2)
+
+    render_dir = args[0]
+    threshold = None
+    report_path = os.path.join(render_dir, 'dedup_report.json')
+    list_path = None
+    pruned_path = None
+    delete = False
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt == '-t':
+            threshold = float(arg)
+        elif opt == '-r':
+            report_path = arg
+        elif opt == '--prune-list':
+            list_path = arg
+        elif opt == '-o':
+            pruned_path = arg
+        elif opt == '--delete':
+            delete = True
+    if threshold is None:
+        if list_path is not None or delete:
+            print('--prune-list and --delete need -t')
+            print(usage)
+            sys.exit(2)
+        threshold = THRESHOLD
+    if list_path is not None and pruned_path is None:
+        root, ext = os.path.splitext(list_path)
+        pruned_path = root + '_pruned' + ext
+
+    duplicates = dedup_renders(render_dir, threshold)
+    report = make_report(duplicates, threshold)
+    removed = removed_groups(duplicates)
+    if list_path is not None:
+        report['list_lines_removed'] = prune_list(list_path, pruned_path,
+                                                  removed)
+        print('Pruned list written to %s' % pruned_path)
+    if delete:
+        report['files_deleted'] = delete_groups(render_dir, removed)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for model in sorted(report['models']):
+        stats = report['models'][model]
+        print('%s: %d of %d groups are duplicates' % (
+            model, stats['removed'], stats['groups']))
+    print('%d of %d groups (%.1f%%) removed, report in %s' % (
+        report['removed'], report['groups'],
+        100 * report['removed_fraction'], report_path))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])